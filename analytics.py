@@ -0,0 +1,181 @@
+"""
+Daily analytics of counts across snapshots.
+Counts are aligned to a daily grid, then daily new cases, rolling averages,
+growth rate and doubling time are computed for all names and count cols
+at once, on arrays in shape of (days, names, count cols).
+    METRICS: names of computed metrics
+    LOG_METRICS: metrics in scale of counts, colored in log scale
+    WINDOW: days of rolling window
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+from inventory_manager import COUNT_COLS
+from count_matrix import MISSING
+
+METRICS = ['cumulative', 'new', 'rolling', 'growth', 'doubling']
+LOG_METRICS = ['cumulative', 'new', 'rolling']
+WINDOW = 7
+
+
+def daily_grid(array, times):
+    """
+    Align snapshots to daily grid.
+    The last snapshot of each day is used, missing days and names missing
+    in a snapshot take the last known counts, as counts are cumulative.
+    inputs:
+        array: counts in shape of (snapshots, names, count cols), NaN for missing
+        times: DatetimeIndex of snapshots, sorted
+    outputs:
+        grid: counts in shape of (days, names, count cols)
+        days: DatetimeIndex of days
+    """
+    array = np.asarray(array, dtype=float)
+    snapshot_days = pd.DatetimeIndex(times).normalize()
+    days = pd.date_range(snapshot_days[0], snapshot_days[-1], freq='D')
+    # Forward fill along snapshots, by index of last known count
+    known = ~np.isnan(array)
+    last = np.where(known, np.arange(len(array))[:, None, None], 0)
+    np.maximum.accumulate(last, axis=0, out=last)
+    filled = np.take_along_axis(array, last, axis=0)
+    # Last snapshot on or before each day
+    rows = np.searchsorted(snapshot_days.asi8, days.asi8, side='right') - 1
+    return filled[rows], days
+
+
+def new_cases(grid):
+    """
+    Daily new cases, NaN on the first day.
+    Corrections of counts may give negative values, they are kept.
+    inputs:
+        grid: counts on daily grid
+    outputs:
+        new: array in shape of grid
+    """
+    new = np.full_like(grid, np.nan)
+    new[1:] = np.diff(grid, axis=0)
+    return new
+
+
+def rolling_mean(values, window=WINDOW):
+    """
+    Trailing rolling mean along days, NaN values are skipped.
+    inputs:
+        values: array in shape of (days, ...)
+        window: days of rolling window
+    outputs:
+        mean: array in shape of values, NaN if no value in window
+    """
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0), axis=0)
+    nums = np.cumsum(valid, axis=0)
+    sums[window:] = sums[window:] - sums[:-window]
+    nums[window:] = nums[window:] - nums[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(nums > 0, sums / np.maximum(nums, 1), np.nan)
+
+
+def growth_rate(grid, window=WINDOW):
+    """
+    Mean daily growth rate of counts over trailing window.
+    rate = (count[t] / count[t - window]) ** (1 / window) - 1,
+    the window is shorter at the beginning.
+    inputs:
+        grid: counts on daily grid
+        window: days of trailing window
+    outputs:
+        rate: array in shape of grid, NaN if earlier count is not positive
+    """
+    lags = np.minimum(np.arange(len(grid)), window)
+    earlier = grid[np.arange(len(grid)) - lags]
+    lags = lags.reshape((-1,) + (1,) * (grid.ndim - 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = (grid / earlier) ** (1 / lags) - 1
+    return np.where((earlier > 0) & (lags > 0), rate, np.nan)
+
+
+def doubling_time(rate):
+    """
+    Days of doubling of counts at growth rate.
+    inputs:
+        rate: daily growth rate
+    outputs:
+        days: array in shape of rate, NaN if not growing
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        days = np.log(2) / np.log1p(rate)
+    return np.where(rate > 0, days, np.nan)
+
+
+def compute(array, times, window=WINDOW):
+    """
+    Compute all metrics in one pass.
+    inputs:
+        array: counts in shape of (snapshots, names, count cols)
+        times: DatetimeIndex of snapshots
+        window: days of rolling window and growth rate
+    outputs:
+        metrics: dict of metric -> array in shape of (days, names, count cols)
+        days: DatetimeIndex of days
+    """
+    grid, days = daily_grid(array, times)
+    new = new_cases(grid)
+    rate = growth_rate(grid, window)
+    metrics = {'cumulative': grid,
+               'new': new,
+               'rolling': rolling_mean(new, window),
+               'growth': rate,
+               'doubling': doubling_time(rate)}
+    return metrics, days
+
+
+def daily_metrics(array, times, names, count_cols, window=WINDOW):
+    """
+    Compute metrics as DataFrames in layout of INV_MANAGER.get_cube.
+    inputs:
+        array, times: as compute, like outputs of INV_MANAGER.get_cube_array
+        names: names of the 2nd axis of array
+        count_cols: names of the 3rd axis of array
+        window: days of rolling window and growth rate
+    outputs:
+        metrics: dict of metric -> DataFrame indexed by day,
+                 columns are (count col, name) MultiIndex
+    """
+    arrays, days = compute(array, times, window)
+    columns = pd.MultiIndex.from_product([count_cols, names])
+    metrics = dict()
+    for metric, values in arrays.items():
+        values = values.transpose(0, 2, 1).reshape(len(days), -1)
+        metrics[metric] = pd.DataFrame(values, index=days, columns=columns)
+    logging.info(f'Daily metrics of {len(names)} names over {len(days)} days.')
+    return metrics
+
+
+def inventory_metrics(manager, level='city', window=WINDOW):
+    """
+    Compute metrics of inventory.
+    inputs:
+        manager: INV_MANAGER of the inventory
+        level: 'province' or 'city'
+        window: days of rolling window and growth rate
+    outputs:
+        metrics: dict of metric -> DataFrame as daily_metrics
+    """
+    array, times, names = manager.get_cube_array(level)
+    return daily_metrics(array, times, names, COUNT_COLS, window)
+
+
+def matrix_metrics(cm, names=None, window=WINDOW):
+    """
+    Compute metrics of COUNT_MATRIX, without reading snapshot files.
+    inputs:
+        cm: COUNT_MATRIX of the inventory
+        names: list of names, all rows as default
+        window: days of rolling window and growth rate
+    outputs:
+        metrics: dict of metric -> DataFrame as daily_metrics
+    """
+    matrix, times, names = cm.get(names)
+    array = np.where(matrix == MISSING, np.nan, matrix)
+    return daily_metrics(array, times, names, COUNT_COLS, window)
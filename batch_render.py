@@ -0,0 +1,152 @@
+"""
+Render maps of the whole inventory without interaction.
+One html is rendered for each snapshot, on a process pool,
+snapshots rendered after their last change are skipped.
+    OUTPUT_DIR: dir of rendered html files
+    HTML_FILENAME: filename of rendered html file of a snapshot
+Usage:
+    python batch_render.py [--out-dir maps] [--workers 4] [--split | --lazy] [--force] [--no-cache]
+"""
+
+import os
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from local_profiles import profiles
+from local_toolbox import readDF
+from mapper_server import MAPPER_SERVER
+from painter import PAINTER, write_plotlyjs
+from render_cache import RENDER_CACHE
+from snapshot_store import listSnapshots, readAllTables
+
+OUTPUT_DIR = 'maps'
+HTML_FILENAME = 'ncov_map_{}.html'
+
+
+def outdated_snapshots(snapshots, out_dir, force=False):
+    """
+    Select snapshots to render.
+    inputs:
+        snapshots: dict of stamp -> path of snapshot file
+        out_dir: dir of rendered html files
+        force: if render all snapshots
+    outputs:
+        jobs: dict of stamp -> (path of snapshot file, path of html file)
+    """
+    jobs = dict()
+    for stamp, path in snapshots.items():
+        html_path = os.path.join(out_dir, HTML_FILENAME.format(stamp))
+        if (not force
+                and os.path.exists(html_path)
+                and os.path.getmtime(html_path) >= os.path.getmtime(path)):
+            continue
+        jobs[stamp] = (path, html_path)
+    return jobs
+
+
+def warm_memory(snapshots):
+    """
+    Check out positions of all cities of snapshots in the main process,
+    so workers only read geocode memory and never write it.
+    inputs:
+        snapshots: dict of stamp -> path of snapshot file
+    outputs:
+        missing: set of names failed to geocode, not searched again by workers
+    """
+    city_df = readAllTables(snapshots)[1]
+    if not len(city_df):
+        return set()
+    ms = MAPPER_SERVER()
+    ms.checkout_many(city_df['provinceName'] + ' ' + city_df['cityName'])
+    ms.solid_memory()
+    return ms.missing
+
+
+def render_one(path, html_path, split=False, lazy=False, use_cache=True, missing=None):
+    """
+    Render one snapshot, runs in worker process.
+    inputs:
+        path: path of snapshot file
+        html_path: path of html file
+        split: if write plotly.js and figure data as separate files
+        lazy: if write traces of provinces as separate files
+        use_cache: if use RENDER_CACHE to skip unchanged snapshots
+        missing: set of names failed to geocode, as warm_memory
+    outputs:
+        html_path: path of html file
+    """
+    painter = PAINTER(missing=missing)
+    painter.load(readDF(path))
+    painter.draw(HTML_FILENAME=html_path, split=split, lazy=lazy, show=False,
+                 cache=RENDER_CACHE() if use_cache else None)
+    return html_path
+
+
+def render_all(out_dir=OUTPUT_DIR, workers=None, split=False, lazy=False, force=False, use_cache=True):
+    """
+    Render snapshots of inventory on a process pool.
+    inputs:
+        out_dir: dir of rendered html files
+        workers: number of worker processes, None for number of CPUs
+        split: if write plotly.js and figure data as separate files
+        lazy: if write traces of provinces as separate files
+        force: if render all snapshots, instead of changed ones
+        use_cache: if use RENDER_CACHE to skip unchanged snapshots
+    outputs:
+        rendered: list of paths of rendered html files
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = outdated_snapshots(listSnapshots(profiles.inventory_dir),
+                              out_dir, force=force)
+    message = f'{len(jobs)} snapshots to render into {out_dir}.'
+    print(message)
+    logging.info(message)
+    if not jobs:
+        return []
+
+    missing = warm_memory({stamp: job[0] for stamp, job in jobs.items()})
+
+    # plotly.min.js of split output is shared, write it before the workers
+    if split or lazy:
+        write_plotlyjs(out_dir)
+
+    rendered = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(render_one, *job, split=split, lazy=lazy,
+                               use_cache=use_cache, missing=missing): stamp
+                   for stamp, job in jobs.items()}
+        for future in as_completed(futures):
+            stamp = futures[future]
+            try:
+                rendered.append(future.result())
+            except Exception as err:
+                message = f'Fail on rendering {stamp}: {repr(err)}'
+                print(message)
+                logging.error(message)
+                continue
+            print(f'Rendered {stamp}.')
+    return rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--out-dir', default=OUTPUT_DIR,
+                        help='dir of rendered html files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--split', action='store_true',
+                        help='write plotly.js and figure data separately')
+    parser.add_argument('--lazy', action='store_true',
+                        help='load traces of provinces on demand')
+    parser.add_argument('--force', action='store_true',
+                        help='render all snapshots, not only changed ones')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use render cache')
+    args = parser.parse_args()
+    rendered = render_all(out_dir=args.out_dir,
+                          workers=args.workers,
+                          split=args.split,
+                          lazy=args.lazy,
+                          force=args.force,
+                          use_cache=not args.no_cache)
+    print(f'{len(rendered)} snapshots rendered.')
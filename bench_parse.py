@@ -0,0 +1,136 @@
+"""
+Benchmark of parsing remote page of REMOTE_URL.
+The legacy path parses the DOM with BeautifulSoup, scans areaStat char by
+char, and round-trips it through json and pd.read_json.
+The current path decodes areaStat at its offset of the raw page.
+Saved pages are used as fixtures, a page is made from the last snapshot
+of the inventory if no page is given.
+Usage:
+    python bench_parse.py [--repeat 5] [page.html ...]
+"""
+
+import json
+import time
+import argparse
+import pandas as pd
+from local_toolbox import getTimeStamp, parseAreaStat
+from snapshot_store import listSnapshots, stampOf
+
+# Layout of the remote page, other scripts are as large as areaStat
+PAGE_TEMPLATE = """<!DOCTYPE html><html><head><meta charset="utf-8">
+<script id="getListByCountryTypeService2">try {{ window.getListByCountryTypeService2 = {other}}}catch(e){{}}</script>
+<script id="getAreaStat">try {{ window.getAreaStat = {areaStat}}}catch(e){{}}</script>
+<script>window.timeStamp={timeStamp}</script>
+</head><body><div id="root"></div></body></html>
+"""
+
+
+def make_page(areaStat, timeStamp):
+    """
+    Make page in the layout of REMOTE_URL.
+    inputs:
+        areaStat: list of dict of provinces, with nested cities
+        timeStamp: time stamp in seconds
+    outputs:
+        page: text of the page
+    """
+    text = json.dumps(areaStat, ensure_ascii=False, separators=(',', ':'))
+    return PAGE_TEMPLATE.format(other=text, areaStat=text,
+                                timeStamp=int(timeStamp * 1000))
+
+
+def make_default_page():
+    """
+    Make page from the last snapshot of inventory.
+    outputs:
+        page: text of the page
+    """
+    from local_toolbox import readDF
+    path = list(listSnapshots().values())[-1]
+    raw_df = readDF(path)
+    timeStamp = time.mktime(time.strptime(stampOf(path), '%Y%m%d-%H%M%S'))
+    return make_page(json.loads(raw_df.to_json(orient='records')), timeStamp)
+
+
+def legacy_parse(html):
+    """
+    Legacy path, as getRemoteText, getAreaStat and fetch used to do.
+    inputs:
+        html: text of the page
+    outputs:
+        counting_df: DataFrame of counting
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, features='lxml')
+    # Recent bs4 drops script strings from .text, use the markup instead
+    text = str(soup.contents[1])
+    subtext = text[text.find("window.getAreaStat")::]
+    subtext = subtext[subtext.find("[{")::]
+    num = 0
+    chars = []
+    for c in subtext:
+        chars.append(c)
+        if c == '[':
+            num += 1
+        if c == ']':
+            num -= 1
+        if num == 0:
+            break
+    counting_json = json.loads(''.join(chars))
+    return pd.read_json(json.dumps(counting_json))
+
+
+def current_parse(html):
+    """
+    Current path, as fetch does.
+    inputs:
+        html: text of the page
+    outputs:
+        counting_df: DataFrame of counting
+    """
+    getTimeStamp(html)
+    return pd.DataFrame(parseAreaStat(html))
+
+
+def bench(pages, repeat=5):
+    """
+    Benchmark both paths on pages, the best of repeats is kept.
+    inputs:
+        pages: dict of name -> text of page
+        repeat: times of parsing each page
+    outputs:
+        results: dict of name -> seconds of both paths
+    """
+    results = dict()
+    for name, html in pages.items():
+        result = {'bytes': len(html.encode())}
+        for label, parse in [('legacy', legacy_parse),
+                             ('current', current_parse)]:
+            seconds = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                df = parse(html)
+                seconds.append(time.perf_counter() - t)
+            result[label] = min(seconds)
+            result[f'{label}_rows'] = len(df)
+        results[name] = result
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times of parsing each page')
+    parser.add_argument('pages', nargs='*',
+                        help='saved pages of REMOTE_URL')
+    args = parser.parse_args()
+    pages = dict()
+    for path in args.pages:
+        with open(path, encoding='utf-8') as f:
+            pages[path] = f.read()
+    if not pages:
+        pages['last snapshot'] = make_default_page()
+    for name, result in bench(pages, repeat=args.repeat).items():
+        print('{}: {} bytes, legacy {:.4f}s, current {:.4f}s, {:.1f}x'.format(
+            name, result['bytes'], result['legacy'], result['current'],
+            result['legacy'] / result['current']))
@@ -0,0 +1,196 @@
+"""
+Benchmark of the load, geocode and draw pipeline.
+The bundled inventory and geocode memory are copied into a temporary dir,
+geocoding is served by a stub backend without network,
+each stage is timed, then run again under tracemalloc for its peak memory.
+    STAGES: names of stages in order of the pipeline
+Usage:
+    python bench_pipeline.py [--repeat 3] [--cold] [--stamp 20200204-124100] [--output bench_pipeline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import functools
+import tracemalloc
+from local_profiles import profiles
+
+STAGES = ['check_inventory_cold',
+          'check_inventory_warm',
+          'read_df',
+          'painter_load',
+          'figure_cold',
+          'figure_patched',
+          'draw']
+
+
+def stubBackend(name):
+    """
+    Geocoding backend without network, positions are made from the hash of name.
+    inputs:
+        name: name of location
+    outputs:
+        lat: latitude of location, in the range of China
+        lng: longitude of location, in the range of China
+    """
+    digest = hashlib.md5(name.encode()).digest()
+    return (18 + digest[0] / 255 * 35,
+            74 + digest[1] / 255 * 60)
+
+
+def setup_sandbox(dirname, cold=False):
+    """
+    Copy inventory and geocode memory into dirname, and use them.
+    inputs:
+        dirname: temporary dir
+        cold: if start with empty geocode memory
+    """
+    inventory_dir = os.path.join(dirname, 'ncov_inventory')
+    mapper_server_dir = os.path.join(dirname, 'maper_server_memory')
+    shutil.copytree(profiles.inventory_dir, inventory_dir)
+    if cold:
+        os.mkdir(mapper_server_dir)
+    else:
+        shutil.copytree(profiles.mapper_server_dir, mapper_server_dir)
+    # Derived files are rebuilt by the stages
+    for name in os.listdir(inventory_dir):
+        if not name.startswith('ncov_counts_'):
+            os.remove(os.path.join(inventory_dir, name))
+    profiles.inventory_dir = inventory_dir
+    profiles.mapper_server_dir = mapper_server_dir
+
+
+def run_stages(dirname, stamp=None):
+    """
+    Run stages of the pipeline once.
+    inputs:
+        dirname: temporary dir, holding the outputs
+        stamp: stamp of snapshot to draw, the last one as default
+    yield:
+        pairs of (name of stage, extra info of stage) after each stage
+    """
+    # Imported after setup_sandbox, so the stub backend is used by painter
+    import painter
+    from inventory_manager import INV_MANAGER, MANIFEST_NAME
+    from local_toolbox import readDF
+    from mapper_server import MAPPER_SERVER
+    painter.MAPPER_SERVER = functools.partial(MAPPER_SERVER,
+                                              backend=stubBackend, rate=None)
+
+    manifest_path = os.path.join(profiles.inventory_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manager = INV_MANAGER()
+    yield 'check_inventory_cold', {'files': len(manager.COUNT_FILE_DF)}
+    manager._check_inventory()
+    yield 'check_inventory_warm', {}
+
+    df = manager.COUNT_FILE_DF
+    if stamp is not None:
+        df = df[df['path'].str.contains(stamp, regex=False)]
+    path = df['path'].values[-1]
+    raw_df = readDF(path)
+    yield 'read_df', {'path': os.path.basename(path)}
+
+    p = painter.PAINTER()
+    p.load(raw_df)
+    yield 'painter_load', {'cities': len(p.provinces_df)}
+
+    # Skeletons are kept across runs in the process, build it from scratch
+    painter._skeletons.clear()
+    args = (p.country_df, p.countryName, p.provinces_df, p.provinceNames)
+    fig = painter.figure_of(*args)
+    yield 'figure_cold', {'traces': len(fig.data)}
+
+    painter.figure_of(*args)
+    yield 'figure_patched', {}
+
+    html_path = os.path.join(dirname, 'index.html')
+    p.draw(HTML_FILENAME=html_path, show=False)
+    yield 'draw', {'output_bytes': os.path.getsize(html_path)}
+
+
+def bench(repeat=3, cold=False, stamp=None):
+    """
+    Benchmark stages, the best time of repeats is kept.
+    inputs:
+        repeat: times of running the pipeline for timing
+        cold: if start with empty geocode memory in each run
+        stamp: stamp of snapshot to draw, the last one as default
+    outputs:
+        results: dict of stage -> dict of seconds, peak_bytes and extra info
+    """
+    inventory_dir = profiles.inventory_dir
+    mapper_server_dir = profiles.mapper_server_dir
+    results = {stage: {'seconds': float('inf')} for stage in STAGES}
+    try:
+        for num in range(repeat + 1):
+            # The last run is under tracemalloc, for memory only
+            traced = num == repeat
+            profiles.inventory_dir = inventory_dir
+            profiles.mapper_server_dir = mapper_server_dir
+            with tempfile.TemporaryDirectory() as dirname:
+                setup_sandbox(dirname, cold=cold)
+                if traced:
+                    tracemalloc.start()
+                t = time.perf_counter()
+                for stage, info in run_stages(dirname, stamp=stamp):
+                    seconds = time.perf_counter() - t
+                    result = results[stage]
+                    result.update(info)
+                    if traced:
+                        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.reset_peak()
+                    else:
+                        result['seconds'] = min(result['seconds'], seconds)
+                    t = time.perf_counter()
+                if traced:
+                    tracemalloc.stop()
+    finally:
+        profiles.inventory_dir = inventory_dir
+        profiles.mapper_server_dir = mapper_server_dir
+    return results
+
+
+def environment():
+    """
+    Environment of the run, for comparing results run over run.
+    outputs:
+        env: dict of versions
+    """
+    import numpy
+    import pandas
+    import plotly
+    return {'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': numpy.__version__,
+            'pandas': pandas.__version__,
+            'plotly': plotly.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times of running the pipeline for timing')
+    parser.add_argument('--cold', action='store_true',
+                        help='start with empty geocode memory')
+    parser.add_argument('--stamp', default=None,
+                        help='stamp of snapshot to draw, the last one as default')
+    parser.add_argument('--output', default=None,
+                        help='json file of results')
+    args = parser.parse_args()
+    results = bench(repeat=args.repeat, cold=args.cold, stamp=args.stamp)
+    for stage, result in results.items():
+        print('{:22s} {:8.3f}s  peak {:8.1f} MB'.format(
+            stage, result['seconds'], result.get('peak_bytes', 0) / 2 ** 20))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'stages': results},
+                      f, indent=2, ensure_ascii=False)
@@ -0,0 +1,99 @@
+"""
+Startup benchmark of modules.
+Every module is imported in a fresh interpreter with -X importtime,
+the time of importing it and the heavy dependencies it pulls in are reported.
+Modules of the project import the HTTP, geocoding and plotting stacks
+inside the functions using them, unless they are built on them like painter,
+so a module starts fast unless its slow path is taken.
+    MODULES: modules of the project to benchmark
+    HEAVY_MODULES: dependencies which should be imported on use only
+Usage:
+    python bench_startup.py [--repeat 3] [--output bench_startup.json]
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = ['instrument',
+           'local_profiles',
+           'json_codec',
+           'local_toolbox',
+           'snapshot_store',
+           'inventory_manager',
+           'mapper_server',
+           'gazetteer',
+           'spatial_index',
+           'render_cache',
+           'fetch_last_counts',
+           'painter',
+           'batch_render',
+           'count_matrix',
+           'analytics',
+           'poller',
+           'web_server']
+HEAVY_MODULES = ['plotly', 'requests', 'bs4', 'lxml', 'geocoder']
+
+
+def measure(module):
+    """
+    Measure importing of module in a fresh interpreter.
+    inputs:
+        module: name of module
+    outputs:
+        result: dict of total seconds, seconds of top level imports,
+                and heavy modules imported
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime',
+                           '-c', f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    # Lines are 'import time: self [us] | cumulative | imported package'
+    cumulative = dict()
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = line[len('import time:'):].split('|')
+        imported.add(name.strip().split('.')[0])
+        # Top level imports are indented by one space
+        if len(name) - len(name.lstrip()) == 1:
+            cumulative[name.strip()] = int(cum) / 1e6
+    return {'seconds': cumulative.get(module, 0),
+            'top_imports': dict(sorted(cumulative.items(),
+                                       key=lambda e: -e[1])[:5]),
+            'heavy': sorted(imported & set(HEAVY_MODULES))}
+
+
+def bench(modules=MODULES, repeat=3):
+    """
+    Benchmark modules, the best of repeats is kept.
+    inputs:
+        modules: list of names of modules
+        repeat: times of measuring each module
+    outputs:
+        results: dict of module -> result of measure
+    """
+    results = dict()
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        results[module] = min(runs, key=lambda e: e['seconds'])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times of measuring each module')
+    parser.add_argument('--output', default=None,
+                        help='json file of results')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='modules to benchmark')
+    args = parser.parse_args()
+    results = bench(args.modules, repeat=args.repeat)
+    for module, result in results.items():
+        print('{:20s} {:8.3f}s  heavy: {}'.format(
+            module, result['seconds'], ', '.join(result['heavy']) or '-'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
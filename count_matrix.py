@@ -0,0 +1,265 @@
+"""
+Memory-mapped counts matrix of the inventory.
+Counts of all snapshots are kept in a raw int32 file in shape of
+(snapshots, rows, count cols), rows are provinces and cities,
+with a json index of names of rows and stamps of snapshots.
+New snapshots are appended to the file, processes map it and share it
+without reading snapshot files.
+    MATRIX_NAME: name of matrix file in inventory dir
+    INDEX_NAME: name of index file in inventory dir
+    MISSING: count of names not exist in a snapshot
+    ROWS_STEP: rows are allocated in steps, the matrix is rebuilt when full
+Usage:
+    python count_matrix.py [--rebuild]
+"""
+
+import os
+import json
+import bisect
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+from local_profiles import profiles
+from local_toolbox import atomicWrite
+from snapshot_store import listSnapshots, readAllTables
+from inventory_manager import COUNT_COLS
+
+MATRIX_NAME = 'count_matrix.int32'
+INDEX_NAME = 'count_matrix_index.json'
+MISSING = -1
+ROWS_STEP = 256
+
+
+def _sourceOf(path):
+    # Entry of snapshot file in index, changed file means changed entry
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime]
+
+
+class COUNT_MATRIX():
+    def __init__(self, dir=None):
+        """
+        Builtin init method.
+        inputs:
+            dir: dir of inventory, profiles.inventory_dir as default
+        yield:
+            self.index: dict of stamps, sources, names and capacity of rows
+            self.rows: dict of name -> row, name of city is
+                       'provinceName cityName' as INV_MANAGER.get_cube
+        """
+        self.dir = dir or profiles.inventory_dir
+        self.matrix_path = os.path.join(self.dir, MATRIX_NAME)
+        self.index_path = os.path.join(self.dir, INDEX_NAME)
+        self._read_index()
+
+    def _read_index(self):
+        self.index = {'stamps': [], 'sources': [], 'names': [],
+                      'provinces': [], 'capacity': 0}
+        if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                self.index = json.load(f)
+        self.rows = {name: row for row, name in enumerate(self.index['names'])}
+
+    def _solid_index(self):
+        atomicWrite(self.index_path,
+                    lambda f: json.dump(self.index, f, ensure_ascii=False),
+                    mode='w')
+
+    def update(self, rebuild=False):
+        """
+        Update matrix by snapshots of inventory.
+        New snapshots after the last one are appended,
+        the matrix is rebuilt if old snapshots change or rows are full.
+        inputs:
+            rebuild: if rebuild the matrix anyway
+        outputs:
+            num: number of snapshots written
+        """
+        snapshots = listSnapshots(self.dir)
+        stamps = self.index['stamps']
+        sources = [_sourceOf(path) for path in snapshots.values()]
+        known = len(stamps)
+        if (rebuild
+                or list(snapshots)[:known] != stamps
+                or sources[:known] != self.index['sources']
+                or not os.path.exists(self.matrix_path)
+                or os.path.getsize(self.matrix_path) < self._nbytes(known)):
+            return self._rebuild(snapshots, sources)
+
+        new = dict(list(snapshots.items())[known:])
+        if not new:
+            return 0
+        tables = readAllTables(new)
+        names, provinces = self._names_of(*tables)
+        if len(self.index['names']) + len(names) > self.index['capacity']:
+            return self._rebuild(snapshots, sources)
+
+        self._add_names(names, provinces)
+        frames = self._frames(new, *tables)
+        # Index follows data, readers never see rows not written,
+        # rows left by an interrupted update are dropped
+        with open(self.matrix_path, 'r+b') as f:
+            f.truncate(self._nbytes(known))
+            f.seek(0, os.SEEK_END)
+            f.write(frames.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.index['stamps'] += list(new)
+        self.index['sources'] = sources
+        self._solid_index()
+        logging.info(f'Count matrix appended {len(new)} snapshots.')
+        return len(new)
+
+    def _nbytes(self, num):
+        # Size of matrix file of num snapshots
+        return num * self.index['capacity'] * len(COUNT_COLS) * 4
+
+    def _rebuild(self, snapshots, sources):
+        """
+        Rebuild matrix of all snapshots.
+        inputs:
+            snapshots: dict of stamp -> path
+            sources: list of entries of snapshot files
+        outputs:
+            num: number of snapshots written
+        """
+        tables = readAllTables(snapshots)
+        self.index = {'stamps': list(snapshots), 'sources': sources,
+                      'names': [], 'provinces': [], 'capacity': 0}
+        self.rows = dict()
+        if snapshots:
+            self._add_names(*self._names_of(*tables))
+        self.index['capacity'] = (len(self.rows) // ROWS_STEP + 1) * ROWS_STEP
+        frames = self._frames(snapshots, *tables)
+        # Mapped old file stays valid for its readers
+        atomicWrite(self.matrix_path, lambda f: f.write(frames.tobytes()))
+        self._solid_index()
+        logging.info(f'Count matrix rebuilt of {len(snapshots)} snapshots.')
+        return len(snapshots)
+
+    def _names_of(self, prov_df, city_df):
+        # Names of provinces and cities not in rows yet
+        provinces, names = [], []
+        if len(prov_df):
+            provinces = list(dict.fromkeys(prov_df['provinceName']))
+        if len(city_df):
+            names = list(dict.fromkeys(city_df['provinceName'] + ' ' +
+                                       city_df['cityName']))
+        provinces = [e for e in provinces if e not in self.rows]
+        names = [e for e in provinces + names if e not in self.rows]
+        return names, provinces
+
+    def _add_names(self, names, provinces):
+        for name in names:
+            self.rows[name] = len(self.index['names'])
+            self.index['names'].append(name)
+        self.index['provinces'] += provinces
+
+    def _frames(self, snapshots, prov_df, city_df):
+        """
+        Make frames of counts of snapshots.
+        inputs:
+            snapshots: dict of stamp -> path
+            prov_df: DataFrame of provinces with stamp column
+            city_df: DataFrame of cities with stamp column
+        outputs:
+            frames: int32 array in shape of (snapshots, capacity, count cols)
+        """
+        frames = np.full((len(snapshots), self.index['capacity'],
+                          len(COUNT_COLS)), MISSING, dtype=np.int32)
+        positions = {stamp: num for num, stamp in enumerate(snapshots)}
+        for table, is_city in [(prov_df, False), (city_df, True)]:
+            if not len(table):
+                continue
+            names = table['provinceName']
+            if is_city:
+                names = names + ' ' + table['cityName']
+            counts = table.reindex(columns=COUNT_COLS).to_numpy(dtype=float)
+            counts = np.where(np.isnan(counts), MISSING, counts)
+            frames[table['stamp'].map(positions).to_numpy(),
+                   names.map(self.rows).to_numpy()] = counts
+        return frames
+
+    def open(self):
+        """
+        Map matrix read only, processes mapping it share the pages.
+        outputs:
+            matrix: memmap in shape of (snapshots, rows, count cols),
+                    MISSING if name not exists in the snapshot
+        """
+        shape = (len(self.index['stamps']), self.index['capacity'],
+                 len(COUNT_COLS))
+        if not shape[0]:
+            return np.full((0, 0, len(COUNT_COLS)), MISSING, dtype=np.int32)
+        matrix = np.memmap(self.matrix_path, dtype=np.int32, mode='r',
+                           shape=shape)
+        return matrix[:, :len(self.index['names'])]
+
+    def slice_of(self, start=None, end=None):
+        """
+        Get slice of snapshots in range.
+        inputs:
+            start: stamp or string of date in format of yyyymmdd, None for no limit
+            end: stamp or string of date as start, included, None for no limit
+        outputs:
+            slice: slice of snapshots of the matrix
+        """
+        stamps = self.index['stamps']
+        first = 0 if start is None else bisect.bisect_left(stamps, start)
+        # '~' sorts after digits and '-', so all stamps of end date are included
+        last = len(stamps) if end is None else bisect.bisect_right(stamps, end + '~')
+        return slice(first, last)
+
+    def rows_of(self, names):
+        """
+        Get rows of names.
+        inputs:
+            names: list of names of provinces or cities
+        outputs:
+            rows: array of rows, KeyError raises if any name not found
+        """
+        return np.array([self.rows[name] for name in names], dtype=np.intp)
+
+    def cities_of(self, province):
+        """
+        Get names of cities of province.
+        inputs:
+            province: name of province
+        outputs:
+            names: list of names of cities
+        """
+        prefix = province + ' '
+        return [e for e in self.index['names'] if e.startswith(prefix)]
+
+    def get(self, names=None, start=None, end=None):
+        """
+        Get counts of names in range, as INV_MANAGER.get_cube_array.
+        inputs:
+            names: list of names, all rows as default
+            start, end: range of snapshots as slice_of
+        outputs:
+            array: view of matrix in shape of (snapshots, names, count cols)
+            times: DatetimeIndex of snapshots
+            names: list of names
+        """
+        span = self.slice_of(start, end)
+        matrix = self.open()[span]
+        if names is None:
+            names = self.index['names']
+        else:
+            matrix = matrix[:, self.rows_of(names)]
+        times = pd.to_datetime(self.index['stamps'][span],
+                               format='%Y%m%d-%H%M%S')
+        return matrix, times, names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the matrix of all snapshots')
+    args = parser.parse_args()
+    cm = COUNT_MATRIX()
+    num = cm.update(rebuild=args.rebuild)
+    print(f'{num} snapshots written, {len(cm.index["stamps"])} snapshots '
+          f'of {len(cm.index["names"])} names in matrix.')
@@ -1,32 +1,47 @@
 """
 Fetch last counts from internet.
-    JSON_FILENAME: filename of fetched counting as json file.
+Fetched counting is saved into the columnar snapshot store.
 """
 
-import os
 import time
-import json
 import logging
 import pandas as pd
 import traceback
 from local_profiles import profiles
-from local_toolbox import getRemoteText, getTimeStamp, getAreaStat
+from local_toolbox import getRemoteText, getTimeStamp, parseAreaStat
+from snapshot_store import writeSnapshot
+from count_matrix import COUNT_MATRIX
+from instrument import span
 
 logging.info('Start fetch last counts.')
 
-JSON_FILENAME = os.path.join(profiles.inventory_dir,
-                             'ncov_counts_{}.json')
-
 
+@span('fetch')
 def fetch():
     """
     Begin to fetch lastest counts from internet.
+    outputs:
+        fpath: path of written file
     yield:
-        Will write json file as JSON_FILENAME
+        Will write columnar file into the snapshot store
     """
     # Get remote text
     text = getRemoteText()
+    return save(text)
+
 
+@span('fetch.save')
+def save(text, counting_json=None):
+    """
+    Save counts of remote text.
+    inputs:
+        text: text of response of REMOTE_URL
+        counting_json: areaStat already parsed from text, None to parse it
+    outputs:
+        fpath: path of written file
+    yield:
+        Will write columnar file into the snapshot store
+    """
     # Get timeStamp
     try:
         timeStamp = getTimeStamp(text)
@@ -41,21 +56,25 @@ def fetch():
     # Get counting
     # todo: Something is wrong with the remote url feeding
     try:
-        counting_json = json.loads(getAreaStat(text))
+        if counting_json is None:
+            counting_json = parseAreaStat(text)
     except Exception as err:
         traceback.print_exc()
         print(text)
         raise(err)
 
     # Make counting_df
-    counting_df = pd.read_json(json.dumps(counting_json))
+    counting_df = pd.DataFrame(counting_json)
     print(counting_df)
 
     # Save counting_df
-    fpath = JSON_FILENAME.format(time.strftime(
-        '%Y%m%d-%H%M%S', time.localtime(timeStamp)))
-    counting_df.to_json(fpath)
-    logging.info(f'Save json file {fpath}.')
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(timeStamp))
+    fpath = writeSnapshot(counting_df, stamp)
+    logging.info(f'Save columnar file {fpath}.')
+
+    # Append the snapshot to counts matrix
+    COUNT_MATRIX().update()
+    return fpath
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+"""
+Offline gazetteer of locations.
+Resolve name variants to known positions without network,
+by normalized names and a prefix trie of city names in each province.
+    PROVINCES_JSON: json file of cities with lat and lng
+    PROVINCE_SUFFIXES: suffixes stripped from province names
+    CITY_SUFFIXES: suffixes stripped from city names
+    ALIASES: explicit aliases of normalized city names
+"""
+
+import os
+import json
+import logging
+
+PROVINCES_JSON = 'provinces.json'
+
+PROVINCE_SUFFIXES = ['特别行政区', '维吾尔自治区', '壮族自治区', '回族自治区',
+                     '自治区', '省', '市']
+CITY_SUFFIXES = ['自治州', '自治县', '林区', '地区', '新区', '州', '盟',
+                 '市', '区', '县']
+# Ethnic names before 自治州 or 自治县, like 土家族苗族
+ETHNICS = ['土家族', '苗族', '藏族', '羌族', '彝族', '傣族', '景颇族', '哈尼族',
+           '壮族', '布依族', '侗族', '朝鲜族', '蒙古族', '回族', '白族', '傈僳族',
+           '哈萨克', '柯尔克孜', '蒙古', '黎族', '瑶族']
+
+ALIASES = {
+    '巴音郭楞': '巴州',
+    '克孜勒苏': '克州',
+    '博尔塔拉': '博州',
+}
+
+
+def _strip(name, suffixes):
+    # Strip one suffix, keep at least 2 chars
+    for suffix in suffixes:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            return name[:-len(suffix)]
+    return name
+
+
+def normalizeProvince(name):
+    """
+    Normalize province name.
+    inputs:
+        name: name of province, like 湖北省 or 湖北
+    outputs:
+        name: normalized name, like 湖北
+    """
+    return _strip(name.strip(), PROVINCE_SUFFIXES)
+
+
+def normalizeCity(name):
+    """
+    Normalize city name.
+    inputs:
+        name: name of city, like 恩施土家族苗族自治州 or 恩施州
+    outputs:
+        name: normalized name, like 恩施
+    """
+    name = name.strip()
+    stripped = _strip(name, CITY_SUFFIXES)
+    if name[len(stripped):].startswith('自治'):
+        # Strip ethnic names one by one
+        shorter = _strip(stripped, ETHNICS)
+        while shorter != stripped:
+            stripped, shorter = shorter, _strip(shorter, ETHNICS)
+    return ALIASES.get(stripped, stripped)
+
+
+def splitName(name):
+    """
+    Split name of location into normalized province and city.
+    inputs:
+        name: name like '湖北省 恩施州', or single name like '北京'
+    outputs:
+        province: normalized province name
+        city: normalized city name, '' for single name
+    """
+    parts = name.split(maxsplit=1)
+    province = normalizeProvince(parts[0]) if parts else ''
+    city = normalizeCity(parts[1]) if len(parts) > 1 else ''
+    return province, city
+
+
+class TRIE():
+    """
+    Prefix trie of strings.
+    """
+
+    def __init__(self):
+        self.root = dict()
+
+    def add(self, word):
+        node = self.root
+        for c in word:
+            node = node.setdefault(c, dict())
+        node[None] = word
+
+    def longest_prefix_of(self, query):
+        """
+        Get the longest stored word which is a prefix of query.
+        inputs:
+            query: string to search
+        outputs:
+            word: the stored word, None if not found
+        """
+        node, word = self.root, None
+        for c in query:
+            if c not in node:
+                break
+            node = node[c]
+            word = node.get(None, word)
+        return word
+
+    def completions(self, prefix, limit=2):
+        """
+        Get stored words starting with prefix.
+        inputs:
+            prefix: string of prefix
+            limit: max number of words to return
+        outputs:
+            words: list of stored words
+        """
+        node = self.root
+        for c in prefix:
+            if c not in node:
+                return []
+            node = node[c]
+        words, stack = [], [node]
+        while stack and len(words) < limit:
+            node = stack.pop()
+            for k, v in node.items():
+                if k is None:
+                    words.append(v)
+                else:
+                    stack.append(v)
+        return words[:limit]
+
+
+class GAZETTEER():
+    def __init__(self, memory=None, provinces_path=PROVINCES_JSON):
+        """
+        Builtin init method.
+        inputs:
+            memory: dict of name -> (lat, lng), like MAPPER_SERVER.memory
+            provinces_path: json file of cities with lat and lng
+        yield:
+            self.index: dict of (province, city) -> (lat, lng)
+            self.tries: dict of province -> TRIE of city names
+        """
+        self.index = dict()
+        self.tries = dict()
+        if os.path.exists(provinces_path):
+            self._add_provinces_json(provinces_path)
+        for name, latlng in (memory or dict()).items():
+            self.add(name, latlng)
+        logging.info(f'GAZETTEER indexed {len(self.index)} locations.')
+
+    def _add_provinces_json(self, path):
+        with open(path, encoding='utf-8') as f:
+            content = json.load(f)
+        for idx, city in content['cityName'].items():
+            lat, lng = content['lat'][idx], content['lng'][idx]
+            if lat is None or lng is None:
+                continue
+            self.add(f"{content['provinceName'][idx]} {city}", (lat, lng))
+
+    def add(self, name, latlng):
+        """
+        Add known position of name.
+        inputs:
+            name: name of location
+            latlng: (lat, lng) of location
+        """
+        key = splitName(name)
+        if key in self.index:
+            return
+        self.index[key] = tuple(latlng)
+        province, city = key
+        if city:
+            self.tries.setdefault(province, TRIE()).add(city)
+
+    def resolve(self, name):
+        """
+        Resolve name locally.
+        The normalized name is matched exactly first,
+        then the longest known city name being prefix of it,
+        then the only known city name starting with it.
+        inputs:
+            name: name of location
+        outputs:
+            latlng: (lat, lng) of location, None if not resolved
+        """
+        province, city = splitName(name)
+        if (province, city) in self.index:
+            return self.index[(province, city)]
+        trie = self.tries.get(province)
+        if trie is None or len(city) < 2:
+            return None
+        word = trie.longest_prefix_of(city)
+        if word is not None and len(word) >= 2:
+            return self.index[(province, word)]
+        words = trie.completions(city)
+        if len(words) == 1:
+            return self.index[(province, words[0])]
+        return None
@@ -0,0 +1,191 @@
+"""
+Lightweight instrumentation of the project.
+Spans time named sections, counters count events,
+both are aggregated in memory and reported once at exit of the run.
+Profiling is toggled by environment variables, without editing the code.
+    ENV_PROFILE: environment variable of profiler, 'cprofile' or 'pyinstrument'
+    ENV_PROFILE_OUTPUT: environment variable of profile output path
+    ENV_REPORT: environment variable of report, '-' to print it,
+                or path of json file, the report is logged anyway
+Usage:
+    NCOV_PROFILE=cprofile NCOV_REPORT=- python ui.py
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+ENV_PROFILE = 'NCOV_PROFILE'
+ENV_PROFILE_OUTPUT = 'NCOV_PROFILE_OUTPUT'
+ENV_REPORT = 'NCOV_REPORT'
+
+_lock = threading.Lock()
+# name -> [count, total seconds, max seconds]
+_spans = dict()
+_counters = dict()
+_profiler = None
+
+
+@contextmanager
+def span(name):
+    """
+    Time the section in with statement, or the decorated function.
+    inputs:
+        name: name of span, like 'painter.patch_figure'
+    """
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t
+        with _lock:
+            entry = _spans.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        logging.debug(f'Span {name} takes {seconds:.4f} seconds.')
+
+
+def count(name, num=1):
+    """
+    Add num to counter.
+    inputs:
+        name: name of counter, like 'geocode.memory_hit'
+        num: number to add
+    """
+    if not num:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + num
+
+
+def summary():
+    """
+    Summary of spans and counters of the run.
+    outputs:
+        summary: dict of spans, counters and derived rates
+    """
+    with _lock:
+        spans = {name: {'count': e[0],
+                        'total': e[1],
+                        'mean': e[1] / e[0],
+                        'max': e[2]}
+                 for name, e in sorted(_spans.items(), key=lambda e: -e[1][1])}
+        counters = dict(sorted(_counters.items()))
+    rates = dict()
+    hits = sum(v for k, v in counters.items()
+               if k.startswith('geocode.') and k.endswith('_hit'))
+    lookups = hits + counters.get('geocode.online', 0)
+    if lookups:
+        rates['geocode.hit_rate'] = hits / lookups
+    renders = counters.get('render_cache.hit', 0) + \
+        counters.get('render_cache.miss', 0)
+    if renders:
+        rates['render_cache.hit_rate'] = counters.get('render_cache.hit', 0) / renders
+    return {'spans': spans, 'counters': counters, 'rates': rates}
+
+
+def format_summary(content):
+    """
+    Format summary as text table.
+    inputs:
+        content: summary as summary()
+    outputs:
+        text: lines of spans, counters and rates
+    """
+    lines = ['{:32s} {:>6s} {:>10s} {:>10s} {:>10s}'.format(
+        'span', 'count', 'total', 'mean', 'max')]
+    for name, e in content['spans'].items():
+        lines.append('{:32s} {:6d} {:9.4f}s {:9.4f}s {:9.4f}s'.format(
+            name, e['count'], e['total'], e['mean'], e['max']))
+    for name, num in content['counters'].items():
+        lines.append('{:32s} {:6d}'.format(name, num))
+    for name, rate in content['rates'].items():
+        lines.append('{:32s} {:6.1%}'.format(name, rate))
+    return '\n'.join(lines)
+
+
+def report():
+    """
+    Report summary of the run, registered at exit by setup.
+    yield:
+        Log the summary, and print or write it as ENV_REPORT
+    """
+    stop_profiler()
+    content = summary()
+    if not content['spans'] and not content['counters']:
+        return
+    text = format_summary(content)
+    logging.info(f'Summary of the run:\n{text}')
+    target = os.environ.get(ENV_REPORT)
+    if target == '-':
+        print(text)
+    elif target:
+        with open(target, 'w') as f:
+            json.dump(content, f, indent=2, ensure_ascii=False)
+
+
+def start_profiler(mode):
+    """
+    Start profiler of the run.
+    inputs:
+        mode: 'cprofile' or 'pyinstrument',
+              cprofile is used if pyinstrument is not installed
+    """
+    global _profiler
+    if _profiler is not None:
+        return
+    if mode == 'pyinstrument':
+        try:
+            import pyinstrument
+            _profiler = pyinstrument.Profiler()
+        except ImportError:
+            logging.warning('pyinstrument is not installed, use cProfile.')
+    if _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    else:
+        _profiler.start()
+    logging.info(f'Profiler {type(_profiler).__name__} starts.')
+
+
+def stop_profiler():
+    """
+    Stop profiler and save its output.
+    cProfile output is a stats file for pstats or snakeviz,
+    pyinstrument output is a html page.
+    outputs:
+        path: path of profile output, None if not profiling
+    """
+    global _profiler
+    if _profiler is None:
+        return None
+    if hasattr(_profiler, 'disable'):
+        _profiler.disable()
+        path = os.environ.get(ENV_PROFILE_OUTPUT, 'ncov_profile.prof')
+        _profiler.dump_stats(path)
+    else:
+        _profiler.stop()
+        path = os.environ.get(ENV_PROFILE_OUTPUT, 'ncov_profile.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(_profiler.output_html())
+    _profiler = None
+    logging.info(f'Profile saved into {path}.')
+    return path
+
+
+def setup():
+    """
+    Setup instrumentation of the run, called once by PROFILES.
+    yield:
+        Start profiler if ENV_PROFILE is set, report at exit
+    """
+    mode = os.environ.get(ENV_PROFILE)
+    if mode:
+        start_profiler(mode)
+    atexit.register(report)
@@ -3,8 +3,17 @@ import logging
 import pandas as pd
 from pprint import pprint
 from local_profiles import profiles
-from local_toolbox import readDF, safeGet
-import fetch_last_counts
+from local_toolbox import readDF, safeGet, atomicWrite
+from json_codec import load, dumps, loadMany
+from instrument import span, count
+from snapshot_store import (listSnapshots, readTables, readAllTables, stampOf,
+                            changes)
+
+MANIFEST_NAME = 'inventory_manifest.json'
+COUNT_COLS = ['confirmedCount',
+              'suspectedCount',
+              'curedCount',
+              'deadCount']
 
 
 class INV_MANAGER():
@@ -17,9 +26,14 @@ class INV_MANAGER():
         Builtin init method.
         yield:
             DIR: dir of inventory
+            MANIFEST_PATH: path of inventory manifest
         """
         logging.info('INV_MANAGER starts.')
         self.DIR = profiles.inventory_dir
+        self.MANIFEST_PATH = os.path.join(self.DIR, MANIFEST_NAME)
+        self._signature = None
+        self._cubes = dict()
+        self._index = None
         self._check_inventory()
 
     def list_count_files(self):
@@ -55,39 +69,271 @@ class INV_MANAGER():
         logging.info(df_idx)
         return df_idx
 
+    def get_cube(self, level='province', start=None, end=None, daily=False):
+        """
+        Get dense counts cube across snapshots.
+        The full cube of level is built once and memoized,
+        until the inventory changes.
+        inputs:
+            level: 'province' or 'city'
+            start: string of first date in format of yyyymmdd, None for no limit
+            end: string of last date in format of yyyymmdd, None for no limit
+            daily: if only keep the last snapshot of each day
+        outputs:
+            cube: DataFrame indexed by snapshot time,
+                  columns are (count col, name) MultiIndex,
+                  name of city is 'provinceName cityName',
+                  NaN if name not exists in the snapshot
+        """
+        if level not in self._cubes:
+            self._cubes[level] = self._build_cube(level)
+        cube = self._cubes[level]
+
+        # Filter by date range, end date is included
+        if start is not None:
+            cube = cube[cube.index >= pd.to_datetime(start, format='%Y%m%d')]
+        if end is not None:
+            cube = cube[cube.index < pd.to_datetime(end, format='%Y%m%d')
+                        + pd.Timedelta(days=1)]
+
+        # Keep last snapshot per day
+        if daily:
+            days = cube.index.normalize()
+            cube = cube[~days.duplicated(keep='last')]
+            cube.index = cube.index.normalize()
+
+        return cube
+
+    def get_cube_array(self, level='province', **kwargs):
+        """
+        Get dense counts cube across snapshots as NumPy array.
+        inputs:
+            level: 'province' or 'city'
+            kwargs: start, end and daily as get_cube
+        outputs:
+            array: array in shape of (snapshots, names, count cols)
+            times: DatetimeIndex of snapshots
+            names: Index of names
+        """
+        cube = self.get_cube(level, **kwargs)
+        names = cube[COUNT_COLS[0]].columns
+        array = cube.reindex(columns=pd.MultiIndex.from_product(
+            [COUNT_COLS, names])).to_numpy()
+        array = array.reshape(len(cube), len(COUNT_COLS), len(names))
+        return array.transpose(0, 2, 1), cube.index, names
+
+    def get_count_matrix(self):
+        """
+        Get memory-mapped counts matrix, updated by the inventory.
+        outputs:
+            cm: COUNT_MATRIX of the inventory
+        """
+        # Count matrix imports COUNT_COLS of here, import it on use
+        from count_matrix import COUNT_MATRIX
+        cm = COUNT_MATRIX(self.DIR)
+        cm.update()
+        return cm
+
+    def get_spatial_index(self):
+        """
+        Get spatial index of geocode memory,
+        kept until any file of the inventory changes.
+        outputs:
+            index: SPATIAL_INDEX of names as 'provinceName cityName'
+        """
+        if self._index is None:
+            from mapper_server import MAPPER_SERVER
+            self._index = MAPPER_SERVER().spatial_index()
+        return self._index
+
+    def get_cases_within(self, lat, lng, radius, count_col='confirmedCount', **kwargs):
+        """
+        Get total cases of cities within radius of position across snapshots.
+        inputs:
+            lat, lng: position in degrees
+            radius: radius in km
+            count_col: count col
+            kwargs: start, end and daily as get_cube
+        outputs:
+            totals: Series of total count indexed by snapshot time
+        """
+        cube = self.get_cube('city', **kwargs)[count_col]
+        return self.get_spatial_index().cases_within(lat, lng, radius, cube)
+
+    def get_nearest_affected(self, lat, lng, n=5, idx=-1, count_col='confirmedCount'):
+        """
+        Get nearest cities with positive count in snapshot of idx.
+        inputs:
+            lat, lng: position in degrees
+            n: number of cities
+            idx: index of snapshot, the last one as default
+            count_col: count col
+        outputs:
+            df: DataFrame of distance in km and count, indexed by name
+        """
+        counts = self.get_cube('city')[count_col].iloc[idx].dropna()
+        return self.get_spatial_index().nearest_affected(lat, lng, counts, n=n)
+
+    def get_neighbors(self, name, radius=None, n=5):
+        """
+        Get neighbor cities of city.
+        inputs:
+            name: name of city as 'provinceName cityName'
+            radius: radius in km, the n nearest neighbors if None
+            n: number of neighbors if radius is None
+        outputs:
+            distances: Series of km indexed by name, nearest first
+        """
+        return self.get_spatial_index().neighbors(name, radius=radius, n=n)
+
+    def get_changes(self, idx=-1):
+        """
+        Get rows changed in count file of idx since the previous one.
+        inputs:
+            idx: index of count file, the last one as default
+        outputs:
+            prov_df: DataFrame of provinces added, changed or removed
+            city_df: DataFrame of cities added, changed or removed
+        """
+        stamp = stampOf(self.COUNT_FILE_DF['path'].values[idx])
+        logging.info(f'Get changes of {stamp}.')
+        return changes(stamp, dir=self.DIR)
+
+    @span('inventory.build_cube')
+    def _build_cube(self, level):
+        """
+        Builtin method for build full counts cube of level.
+        inputs:
+            level: 'province' or 'city'
+        outputs:
+            cube: DataFrame as get_cube without filtering
+        """
+        logging.info(f'Build {level} cube.')
+        snapshots = dict(zip(self.COUNT_FILE_DF['path'].map(stampOf),
+                             self.COUNT_FILE_DF['path']))
+        prov_df, city_df = readAllTables(snapshots)
+        if level == 'province':
+            table = prov_df.assign(name=prov_df['provinceName'])
+        elif level == 'city':
+            table = city_df.assign(name=city_df['provinceName'] + ' ' +
+                                   city_df['cityName'])
+        else:
+            raise ValueError(f'Illegal level {level}.')
+        table = table.reindex(columns=['stamp', 'name'] + COUNT_COLS)
+        cube = table.groupby(['stamp', 'name'], sort=False)[COUNT_COLS].sum(
+            min_count=1).unstack('name')
+        cube.index = pd.to_datetime(cube.index, format='%Y%m%d-%H%M%S')
+        return cube.sort_index()
+
     def _update_inventory(self):
         """
         Builtin method for update inventory.
         """
         # fetch lastest counting
+        import fetch_last_counts
         fetch_last_counts.fetch()
         self._check_inventory()
 
+    def _read_manifest(self):
+        """
+        Builtin method for read inventory manifest.
+        outputs:
+            manifest: dict of name -> entry, empty if not exists or broken
+        """
+        if not os.path.exists(self.MANIFEST_PATH):
+            logging.warning(f'Manifest not exists: {self.MANIFEST_PATH}.')
+            return dict()
+        try:
+            return load(self.MANIFEST_PATH)
+        except ValueError as err:
+            logging.error(f'Manifest is broken, rebuild it: {repr(err)}')
+            return dict()
+
+    def _solid_manifest(self, manifest):
+        """
+        Builtin method for write inventory manifest.
+        inputs:
+            manifest: dict of name -> entry
+        yield:
+            Write manifest json file atomically.
+        """
+        atomicWrite(self.MANIFEST_PATH,
+                    lambda f: f.write(dumps(manifest)),
+                    mode='w')
+
+    @span('inventory.check')
     def _check_inventory(self):
         """
-        Builtin init method for check ncov_counts json files in inventory.
+        Builtin init method for check ncov_counts files in inventory.
+        Columnar file is used when both formats exist for the same stamp.
+        Summaries are cached in manifest keyed by name, size and mtime,
+        only new or changed files are scanned.
         yield:
             self.COUNT_FILE_DF: DataFrame for files
         """
-        df = pd.DataFrame()
-        for name in os.listdir(self.DIR):
-            if not name.startswith('ncov_counts_'):
-                logging.info(f'Ignore file {name}.')
-                continue
-            logging.info(f'Found ncov_counts file {name}.')
-            date = name[len('ncov_counts_'):len('ncov_counts_')+8]
-            path = os.path.join(self.DIR, name)
-            
-            inside = pd.read_json(path)
-            sum_confirmedCount = inside['confirmedCount'].sum().astype(int)
-
-            se = pd.Series(data={'date': date,
-                                 'path': path,
-                                 'sum': sum_confirmedCount})
-            df = df.append(se, ignore_index=True)
+        manifest = self._read_manifest()
+        new_manifest = dict()
+        paths = dict()
+        stale = []
+        for stamp, path in listSnapshots(self.DIR).items():
+            name = os.path.basename(path)
+            stat = os.stat(path)
+            entry = manifest.get(name)
+            if (entry is None
+                    or entry['size'] != stat.st_size
+                    or entry['mtime'] != stat.st_mtime):
+                entry = {'stamp': stamp,
+                         'date': stamp[:8],
+                         'size': stat.st_size,
+                         'mtime': stat.st_mtime}
+                stale.append(name)
+            new_manifest[name] = entry
+            paths[name] = path
 
+        # Scan new or changed files in parallel
+        num_scanned = len(stale)
+        sums = loadMany([paths[name] for name in stale], scanFile)
+        for name, summary in zip(stale, sums):
+            new_manifest[name].update(summary)
+        records = [{'date': entry['date'],
+                    'path': paths[name],
+                    'sum': entry.get('sum_confirmedCount', 0)}
+                   for name, entry in new_manifest.items()]
+
+        if num_scanned or len(new_manifest) != len(manifest):
+            self._solid_manifest(new_manifest)
+        logging.info(f'Inventory checked, {num_scanned} files scanned.')
+        count('inventory.scanned', num_scanned)
+
+        df = pd.DataFrame(records, columns=['date', 'path', 'sum'])
         self.COUNT_FILE_DF = df.set_index('date', drop=False)
 
+        # Drop memoized cubes and spatial index if any file changes,
+        # cities of new files are geocoded into memory when painted
+        signature = tuple((name, e['size'], e['mtime'])
+                          for name, e in new_manifest.items())
+        if signature != self._signature:
+            self._signature = signature
+            self._cubes = dict()
+            self._index = None
+
+
+def scanFile(path):
+    """
+    Compute summary of a count file, run in workers of json_codec.loadMany.
+    inputs:
+        path: path of the file
+    outputs:
+        summary: dict of sum_<count col> -> sum of provinces
+    """
+    logging.info(f'Scan ncov_counts file {path}.')
+    inside = readTables(path)[0]
+    summary = dict()
+    for col in COUNT_COLS:
+        if col in inside.columns:
+            summary[f'sum_{col}'] = int(inside[col].sum())
+    return summary
+
 
 def printer(df):
     if df is not None:
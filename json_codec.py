@@ -0,0 +1,147 @@
+"""
+Shared json codec of the project.
+orjson is used when installed, the standard json module otherwise,
+files written by either are read by both.
+Table files are decoded straight into column lists, without pd.read_json,
+and many files are decoded in parallel on a process pool.
+    BACKEND: name of json library in use
+    BULK_MIN: min number of files to decode on the process pool
+"""
+
+import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from instrument import span, count
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'json' if orjson is None else 'orjson'
+BULK_MIN = 8
+JSON_DECODER = json.JSONDecoder()
+
+
+def loads(content):
+    """
+    Decode json.
+    inputs:
+        content: str or bytes of json
+    outputs:
+        obj: decoded object
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Like NaN written by the json module, which orjson rejects
+            pass
+    return json.loads(content)
+
+
+def dumps(obj):
+    """
+    Encode obj as compact json, non-ascii chars are kept as they are.
+    inputs:
+        obj: object to encode, NumPy scalars and arrays are allowed
+    outputs:
+        text: str of json
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY |
+                                orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                      default=_toBuiltin)
+
+
+def _toBuiltin(obj):
+    # NumPy scalars and arrays for the json module
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not json serializable.')
+
+
+def decodeAt(text, start):
+    """
+    Decode the json value starting at offset of text, ignoring the rest.
+    orjson only decodes whole documents, the json module is used.
+    inputs:
+        text: str containing json
+        start: offset of the value in text
+    outputs:
+        obj: decoded object
+        end: offset after the value in text
+    """
+    return JSON_DECODER.raw_decode(text, start)
+
+
+def load(path):
+    """
+    Read json file.
+    inputs:
+        path: path of json file
+    outputs:
+        obj: decoded object
+    """
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def columnsOf(content):
+    """
+    Columns of decoded table.
+    inputs:
+        content: decoded json of a table, as written by DataFrame.to_json
+                 in orient of 'columns' or 'records'
+    outputs:
+        columns: dict of column -> list of values in order of rows,
+                 None if the value is missing
+    """
+    if isinstance(content, list):
+        names = dict.fromkeys(k for row in content for k in row)
+        return {k: [row.get(k) for row in content] for k in names}
+    rows = dict.fromkeys(r for col in content.values() for r in col)
+    return {k: [col.get(r) for r in rows] for k, col in content.items()}
+
+
+def readColumns(path):
+    """
+    Read table json file as columns.
+    inputs:
+        path: path of json file
+    outputs:
+        columns: dict of column -> list of values, as columnsOf
+    """
+    return columnsOf(load(path))
+
+
+@span('codec.load_many')
+def loadMany(paths, func=readColumns, max_workers=None):
+    """
+    Run func on many files in parallel on a process pool.
+    Files are split into contiguous chunks, one chunk per worker,
+    few files are run in this process.
+    inputs:
+        paths: list of paths
+        func: function of path, picklable as a module level function,
+              readColumns as default
+        max_workers: number of processes, os.cpu_count() as default
+    outputs:
+        results: list of func(path) in order of paths
+    """
+    paths = list(paths)
+    count('codec.files', len(paths))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(paths) // BULK_MIN)
+    if max_workers <= 1:
+        return [func(path) for path in paths]
+    logging.info(f'Load {len(paths)} files on {max_workers} processes.')
+    chunksize = -(-len(paths) // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(func, paths, chunksize=chunksize))
@@ -4,6 +4,7 @@ Profiles of the project.
 
 import os
 import logging
+import instrument
 from key_profiles import BAIDU_AK, MAPBOX_ACCESS_TOKEN
 
 REMOTE_URL = 'https://ncov.dxy.cn/ncovh5/view/pneumonia'
@@ -21,6 +22,8 @@ class PROFILES():
         self.mapbox_ak = MAPBOX_ACCESS_TOKEN
         # Invoke logging
         self._invoke_logging()
+        # Invoke instrumentation, profiler is toggled by environment
+        instrument.setup()
         # Basic check
         self._check_dirs()
 
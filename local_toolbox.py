@@ -3,11 +3,15 @@ Local toolbox.
 """
 
 import os
+import re
 import logging
-import requests
+import tempfile
 import pandas as pd
-from bs4 import BeautifulSoup
 from local_profiles import profiles
+from json_codec import readColumns, decodeAt
+from instrument import span, count
+
+TIMESTAMP_PATTERN = re.compile(r'window\.timeStamp\s*=\s*(\d+)')
 
 
 def safeGet(df, key, method='loc'):
@@ -43,11 +47,38 @@ def safeGet(df, key, method='loc'):
         return obj
 
 
+def atomicWrite(path, write, mode='wb'):
+    """
+    Write file atomically.
+    The content is written into a temporary file in the same dir,
+    and replaces path only after it is complete.
+    inputs:
+        path: path of file
+        write: function writing content into the opened file object
+        mode: mode of opening the file, 'wb' or 'w'
+    yield:
+        Write file on path
+    """
+    encoding = None if 'b' in mode else 'utf-8'
+    fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            write(f)
+        # Temporary file is private, keep permission of a normal file
+        os.chmod(tmp, os.stat(path).st_mode if os.path.exists(path) else 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@span('inventory.read_df')
 def readDF(path):
     """
     Read DataFrame on path
     inputs:
-        path: path of json file
+        path: path of json file or columnar file
     outputs:
         df: DataFrame of path, None if error occurred
     """
@@ -57,8 +88,13 @@ def readDF(path):
         logging.error(repr(err))
         return None
     logging.info(f'Reading DataFrame from {path}.')
+    # Columnar store imports local_toolbox, import it on use
+    from snapshot_store import STORE_EXT, readSnapshot
     try:
-        df = pd.read_json(path)
+        if path.endswith(STORE_EXT):
+            df = readSnapshot(path)
+        else:
+            df = pd.DataFrame(readColumns(path))
         return df
     except ValueError as err:
         print(repr(err))
@@ -66,16 +102,18 @@ def readDF(path):
         return None
 
 
+@span('fetch.remote')
 def getRemoteText():
     """
     Require text from REMOTE_URL
+    The raw page is returned as it is, no DOM is parsed.
     outputs:
         remote text
     """
+    import requests
+    count('network.fetch')
     response = requests.get(profiles.remote_url)
-    HTML = response.text.encode(response.encoding).decode()
-    soup = BeautifulSoup(HTML, features='lxml')
-    return soup.contents[1].text
+    return response.content.decode()
 
 
 def getTimeStamp(text):
@@ -87,34 +125,41 @@ def getTimeStamp(text):
     outputs:
         timeStamp: time stamp parsed from text
     """
-    # Fetch timeStamp as between window.timeStamp and </script>
-    timeStamp = float(text.split("window.timeStamp=")[
-                      1].split("</script>")[0]) / 1000
+    # Fetch timeStamp as the number after window.timeStamp=
+    match = TIMESTAMP_PATTERN.search(text)
+    if match is None:
+        raise ValueError('window.timeStamp not found.')
+    timeStamp = float(match.group(1)) / 1000
     return timeStamp
 
 
-def getAreaStat(text):
+@span('fetch.parse')
+def _decodeAreaStat(text):
+    """
+    Decode the array after window.getAreaStat in one pass.
+    inputs:
+        text: text of response of REMOTE_URL
+    outputs:
+        areaStat: decoded list of provinces
+        start: offset of the array in text
+        end: offset after the array in text
+    """
+    start = text.find("window.getAreaStat")
+    if start >= 0:
+        start = text.find("[", start)
+    if start < 0:
+        raise ValueError('getAreaStat not found in page')
+    areaStat, end = decodeAt(text, start)
+    return areaStat, start, end
+
+
+def parseAreaStat(text):
     """
-    Get counting from text.
+    Get counting from text as list of provinces.
     The method is specific to REMOTE_URL.
     inputs:
         text: text of response of REMOTE_URL
     outputs:
-        areaStat: parsed text of counting
+        areaStat: list of dict of provinces, with nested cities
     """
-    # Cut the text after windows.getAreaStat
-    subtext = text[text.find("window.getAreaStat")::]
-    subtext = subtext[subtext.find("[{")::]
-    # Fetch the whole array use finite state automaton
-    num = 0
-    chars = []
-    for c in subtext:
-        chars.append(c)
-        if c == '[':
-            num += 1
-        if c == ']':
-            num -= 1
-        if num == 0:
-            break
-    areaStat = ''.join(chars)
-    return areaStat
+    return _decodeAreaStat(text)[0]
@@ -1,45 +1,307 @@
 """
 My custom mapper server.
 Get latitude and longitude using BAIDU API.
+The geocoding backend is pluggable,
+a backend is a function of name returning (lat, lng),
+raising KeyError if the name can not be resolved.
+Memory is a dict of name -> (lat, lng),
+persisted as memory.json plus an append-only journal of new entries,
+the journal is compacted into memory.json atomically.
+    JOURNAL_LIMIT: number of journal entries to trigger compaction
 """
 
 import os
+import time
+import random
 import logging
-import geocoder
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from local_profiles import profiles
+from local_toolbox import atomicWrite
+from json_codec import load, loads, dumps
+from gazetteer import GAZETTEER
+from spatial_index import indexOf
+from instrument import span, count
+
+JOURNAL_LIMIT = 1000
+
+
+def baiduBackend(name):
+    """
+    Resolve name using BAIDU API.
+    inputs:
+        name: name of location
+    outputs:
+        lat: latitude of location
+        lng: longitude of location
+    """
+    import geocoder
+    g = geocoder.baidu(name, key=profiles.baidu_ak)
+    if not g.latlng:
+        raise KeyError(name)
+    lat, lng = g.latlng
+    return lat, lng
+
+
+class RATE_LIMITER():
+    """
+    Thread safe limiter, calls of wait are spaced at least 1 / rate seconds.
+    """
+
+    def __init__(self, rate):
+        """
+        Builtin init method.
+        inputs:
+            rate: max number of calls per second, None for no limit
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until next call is allowed.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
 
 
 class MAPPER_SERVER():
-    def __init__(self):
+    def __init__(self, backend=baiduBackend, max_workers=8, rate=20,
+                 retries=3, backoff=0.5, use_gazetteer=True, missing=None):
+        """
+        Builtin init method.
+        inputs:
+            backend: function of name returning (lat, lng)
+            use_gazetteer: if resolve name variants by offline gazetteer
+            max_workers: max number of concurrent online searches
+            rate: max number of online searches per second
+            retries: times of retry on failure of backend
+            backoff: base seconds of exponential backoff between retries
+            missing: set of names failed to resolve, not searched again,
+                     shared by reference, a new set if None
+        """
         logging.info('MAPPER_SERVER starts.')
         self.memory_path = os.path.join(
             profiles.mapper_server_dir, 'memory.json')
+        self.journal_path = os.path.join(
+            profiles.mapper_server_dir, 'memory.jsonl')
+        self.backend = backend
+        self.max_workers = max_workers
+        self.rate_limiter = RATE_LIMITER(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.use_gazetteer = use_gazetteer
+        self.missing = set() if missing is None else missing
         self._read_memory()
 
     def _read_memory(self):
         """
-        Read memory json file as DataFrame,
-        if file not exists, use empty DataFrame instead.
+        Read memory json file and replay journal as dict,
+        if file not exists, use empty dict instead.
         yield:
-            self.memory: the memory DataFrame
+            self.memory: the memory dict of name -> (lat, lng)
+            self.unsaved: names remembered but not in journal yet
+            self.journal_size: number of entries in journal
         """
+        self.memory = dict()
+        self.unsaved = []
+        self.journal_size = 0
         if os.path.exists(self.memory_path):
             logging.info(f'Get memory from {self.memory_path}')
-            self.memory = pd.read_json(self.memory_path)
+            content = load(self.memory_path)
+            self.memory = {name: (lat, content['longitude'][name])
+                           for name, lat in content['latitude'].items()}
         else:
             logging.warning(
-                f'Memory file not exists. Use empty DataFrame instead.')
-            self.memory = pd.DataFrame(columns=['latitude',
-                                                'longitude'])
+                f'Memory file not exists. Use empty dict instead.')
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        name, lat, lng = loads(line)
+                    except (ValueError, TypeError):
+                        # Last line may be broken by a crash
+                        logging.warning(f'Ignore broken journal: {line}')
+                        continue
+                    self.memory[name] = (lat, lng)
+                    self.journal_size += 1
+        self._gazetteer = None
+
+    @property
+    def gazetteer(self):
+        """
+        GAZETTEER built on memory on the first miss of memory,
+        None if not used.
+        """
+        if self._gazetteer is None and self.use_gazetteer:
+            self._gazetteer = GAZETTEER(self.memory)
+        return self._gazetteer
 
     def solid_memory(self):
         """
-        Write memory DataFrame into json file.
+        Append new entries of memory into journal,
+        and compact journal into memory json file if it is too long.
+        yield:
+            Write journal file and memory json file.
+        """
+        if self.unsaved:
+            lines = [dumps([name, *self.memory[name]]).encode() + b'\n'
+                     for name in self.unsaved]
+            with open(self.journal_path, 'a+b') as f:
+                # Broken last line of a crash must not swallow new entries
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        lines.insert(0, b'\n')
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            logging.info(f'Append {len(self.unsaved)} entries into journal.')
+            self.journal_size += len(self.unsaved)
+            self.unsaved = []
+        if self.journal_size > JOURNAL_LIMIT:
+            self.compact_memory()
+
+    def compact_memory(self):
+        """
+        Write whole memory into json file atomically, and clear journal.
         yield:
-            Write memory json file.
+            Write memory json file, remove journal file.
         """
-        self.memory.to_json(open(self.memory_path, 'w'))
+        content = {'latitude': {k: v[0] for k, v in self.memory.items()},
+                   'longitude': {k: v[1] for k, v in self.memory.items()}}
+        atomicWrite(self.memory_path,
+                    lambda f: f.write(dumps(content)),
+                    mode='w')
+        # Unsaved entries are in memory json file now
+        self.unsaved = []
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_size = 0
+        logging.info(f'Memory compacted into {self.memory_path}.')
+
+    def _search_offline(self, names):
+        """
+        Search positions of names by gazetteer.
+        inputs:
+            names: list of names of locations
+        outputs:
+            found: dict of name -> (lat, lng) of resolved names
+        """
+        if self.gazetteer is None:
+            return dict()
+        found = dict()
+        for name in names:
+            latlng = self.gazetteer.resolve(name)
+            if latlng is not None:
+                logging.info(f'Search offline: {name}.')
+                found[name] = latlng
+        return found
+
+    def _search_online(self, name):
+        """
+        Search position of name online, with rate limit and retries.
+        inputs:
+            name: name of location
+        outputs:
+            lat: latitude of location, None if not found
+            lng: longitude of location, None if not found
+        """
+        message = f'Search online: {name}.'
+        print(message)
+        logging.info(message)
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            count('network.geocode')
+            try:
+                return self.backend(name)
+            except KeyError as err:
+                # Not found will not be better on retry
+                message = repr(err)
+                print(f'Error occured on checkout {name}: {message}')
+                logging.error(message)
+                return None, None
+            except Exception as err:
+                message = f'Retry {attempt} on checkout {name}: {repr(err)}'
+                logging.warning(message)
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt *
+                               (1 + random.random()))
+        logging.error(f'Give up checkout {name}.')
+        return None, None
+
+    def _remember(self, found):
+        """
+        Add found positions into memory.
+        inputs:
+            found: dict of name -> (lat, lng)
+        yield:
+            Update memory and unsaved, names not found go to missing
+        """
+        for name, latlng in found.items():
+            if latlng[0] is None:
+                self.missing.add(name)
+                continue
+            self.memory[name] = tuple(latlng)
+            self.unsaved.append(name)
+            # Gazetteer not built yet is built on the memory later
+            if self._gazetteer is not None:
+                self._gazetteer.add(name, latlng)
+
+    @span('geocode.checkout_many')
+    def checkout_many(self, names):
+        """
+        Check out positions of names in one batch.
+        Names not remembered are searched by gazetteer,
+        the rest are searched online concurrently, except names in missing.
+        inputs:
+            names: list of names of locations
+        outputs:
+            latlng: DataFrame of latitude and longitude, indexed by names,
+                    NaN if not found
+        yield:
+            Update memory if not remembered
+        """
+        names = list(names)
+        unique = dict.fromkeys(names)
+        missing = [e for e in unique if e not in self.memory]
+        count('geocode.memory_hit', len(unique) - len(missing))
+        if missing:
+            found = self._search_offline(missing)
+            count('geocode.gazetteer_hit', len(found))
+            self._remember(found)
+            missing = [e for e in missing if e not in self.memory]
+        # Names failed before are not searched online again
+        known = [e for e in missing if e in self.missing]
+        count('geocode.missing_hit', len(known))
+        missing = [e for e in missing if e not in self.missing]
+        if missing:
+            count('geocode.online', len(missing))
+            with span('geocode.online'), \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                found = dict(zip(missing,
+                                 pool.map(self._search_online, missing)))
+            self._remember(found)
+        notFound = (float('nan'), float('nan'))
+        return pd.DataFrame([self.memory.get(e, notFound) for e in names],
+                            index=names,
+                            columns=['latitude', 'longitude'])
+
+    def spatial_index(self):
+        """
+        Spatial index of memory, shared by servers of the same memory.
+        outputs:
+            index: SPATIAL_INDEX of names in memory
+        """
+        return indexOf(self.memory)
 
     def checkout(self, name):
         """
@@ -52,25 +314,18 @@ class MAPPER_SERVER():
         yield:
             Update memory if not remembered
         """
-        if name in self.memory.index:
-            lat = self.memory.loc[name].latitude
-            lng = self.memory.loc[name].longitude
+        if name in self.memory:
+            count('geocode.memory_hit')
+            lat, lng = self.memory[name]
+        elif name in self.missing:
+            count('geocode.missing_hit')
+            lat, lng = None, None
         else:
-            message = f'Search online: {name}.'
-            print(message)
-            logging.info(message)
-            try:
-                g = geocoder.baidu(name, key=profiles.baidu_ak)
-                lat, lng = g.latlng
-                se = pd.Series(data={'latitude': lat,
-                                     'longitude': lng},
-                               name=name)
-                self.memory = self.memory.append(se)
-            except KeyError as err:
-                lat, lng = None, None
-                message = repr(err)
-                print(f'Error occured on checkout {name}: {message}')
-                logging.error(message)
+            found = self._search_offline([name])
+            count('geocode.gazetteer_hit', len(found))
+            count('geocode.online', 1 - len(found))
+            lat, lng = found.get(name) or self._search_online(name)
+            self._remember({name: (lat, lng)})
         return lat, lng
 
 
@@ -2,12 +2,19 @@
 Painting ncov counts using plotly.
 """
 
+import os
+import sys
 import json
 import logging
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from local_profiles import profiles
+from local_toolbox import atomicWrite
 from mapper_server import MAPPER_SERVER
+from snapshot_store import splitDF
+from analytics import LOG_METRICS
+from instrument import span
 
 from _plotly_future_ import remove_deprecations
 import plotly
@@ -17,27 +24,121 @@ import plotly.figure_factory as ff
 
 
 class PAINTER():
-    def __init__(self):
+    def __init__(self, missing=None):
         """
         Builtin init method.
+        inputs:
+            missing: set of names failed to geocode, as MAPPER_SERVER,
+                     shared by the loads of this painter
         """
         logging.info('PAINTER starts.')
+        self.missing = set() if missing is None else missing
         self.count_cols = ['confirmedCount',
                            'suspectedCount',
                            'curedCount',
                            'deadCount']
 
+    @span('painter.load')
     def load(self, raw_df):
         """
         Load new raw_df
+        Frames are kept compact, to hold many snapshots in memory,
+        names are categorical, counts are int32 and coordinates are float32.
         inputs:
             raw_df: DataFrame containing raw counting.
+        yield:
+            self.raw_df: DataFrame of provinces, nested cities are only
+                         kept flattened in provinces_df
         """
-        self.raw_df = raw_df.set_index('provinceName', drop=False)
+        prov_df, city_df = splitDF(raw_df)
+        self.raw_df = compactDF(prov_df, self.count_cols)
         self._prepare_country_df()
-        self._prepare_provinces_df()
+        self._prepare_provinces_df(city_df)
+        self.colors = None
         logging.info('New raw_df loaded.')
 
+    def color_by(self, metrics, metric='growth', day=None, count_col='confirmedCount'):
+        """
+        Color cities by daily metric, instead of log of confirmedCount.
+        inputs:
+            metrics: dict of metric -> DataFrame, as analytics.daily_metrics
+                     of city level, None to reset the colors
+            metric: name of metric in analytics.METRICS
+            day: day of the metric, the last day as default
+            count_col: count col of the metric
+        yield:
+            self.colors: color of each row of provinces_df, NaN if unknown
+        """
+        if metrics is None:
+            self.colors = None
+            return
+        df = metrics[metric][count_col]
+        row = df.iloc[-1] if day is None else df.loc[pd.Timestamp(day)]
+        colors = row.reindex(self._city_names()).to_numpy(dtype=float)
+        if metric in LOG_METRICS:
+            colors = np.log10(np.clip(colors, 0, None) + 1)
+        self.colors = colors
+        logging.info(f'Color by {metric} of {count_col} on {row.name}.')
+
+    def _city_names(self):
+        # Names of rows of provinces_df in geocode memory
+        return (self.provinces_df['provinceName'].astype(str) + ' ' +
+                self.provinces_df['cityName'].astype(str)).to_numpy()
+
+    def city_counts(self, count_col='confirmedCount'):
+        """
+        Counts of cities keyed by name in geocode memory.
+        inputs:
+            count_col: count col of provinces_df
+        outputs:
+            counts: Series of counts indexed by 'provinceName cityName'
+        """
+        counts = pd.Series(self.provinces_df[count_col].to_numpy(),
+                           index=self._city_names())
+        return counts.groupby(level=0, sort=False).sum()
+
+    def cases_within(self, lat, lng, radius, count_col='confirmedCount'):
+        """
+        Total cases of cities within radius of position.
+        inputs:
+            lat, lng: position in degrees
+            radius: radius in km
+            count_col: count col of provinces_df
+        outputs:
+            total: total count of the cities
+        """
+        return self.index.cases_within(lat, lng, radius,
+                                       self.city_counts(count_col))
+
+    def nearest_affected(self, lat, lng, n=5, count_col='confirmedCount'):
+        """
+        Nearest cities with positive count.
+        inputs:
+            lat, lng: position in degrees
+            n: number of cities
+            count_col: count col of provinces_df
+        outputs:
+            df: DataFrame of distance in km and count, indexed by name
+        """
+        return self.index.nearest_affected(lat, lng,
+                                           self.city_counts(count_col), n=n)
+
+    def neighbors_of(self, name, radius=None, n=5, count_col='confirmedCount'):
+        """
+        Neighbor cities of city.
+        inputs:
+            name: name of city as 'provinceName cityName'
+            radius: radius in km, the n nearest neighbors if None
+            n: number of neighbors if radius is None
+            count_col: count col of provinces_df
+        outputs:
+            df: DataFrame of distance in km and count, indexed by name,
+                count is NaN if the neighbor is not in the snapshot
+        """
+        distances = self.index.neighbors(name, radius=radius, n=n)
+        counts = self.city_counts(count_col).reindex(distances.index)
+        return pd.DataFrame({'distance': distances, 'count': counts})
+
     def _prepare_country_df(self):
         """
         Prepare country_df for plotting.
@@ -45,79 +146,218 @@ class PAINTER():
             self.country_df: DataFrame containing counts of provinces
             self.countryName: Name of the country
         """
-        country_df = self.raw_df[['provinceName'] + self.count_cols]
-        country_df = country_df.set_index('provinceName', drop=False)
-        self.country_df = country_df
+        self.country_df = self.raw_df[['provinceName'] + self.count_cols]
         self.countryName = '全国'
         logging.info('New country_df prepared.')
 
-    def _prepare_provinces_df(self):
+    def _prepare_provinces_df(self, city_df):
         """
         Prepare provinces_df for plotting.
+        inputs:
+            city_df: DataFrame of cities with provinceName, as splitDF
         yield:
             self.provinceNames: List of names of provinces
             self.provinces_df: DataFrame containing counts of cities
+            self.index: SPATIAL_INDEX of geocode memory
         """
-        ms = MAPPER_SERVER()
-        self.provinceNames = []
-        provinces_df = pd.DataFrame()
-        for prov in self.country_df.index.unique():
-            # Read from self.raw_df
-            cities = self.raw_df.loc[prov].cities
-            if not cities:
-                continue
-            self.provinceNames.append(prov)
-            if isinstance(cities, pd.Series):
-                cities = pd.DataFrame(cities).T
-            else:
-                cities = pd.DataFrame(cities)
-            # Add provinceName
-            cities['provinceName'] = prov
-            # Add latitude and longtitude
-            try:
-                names = prov + ' ' + cities['cityName']
-                latlng = [ms.checkout(name) for name in names]
-            except:
-                latlng = []
-                for name in names:
-                    latlng.append(ms.checkout(name))
-            cities['latitude'] = [e[0] for e in latlng]
-            cities['longitude'] = [e[1] for e in latlng]
-            # Filter and order columns
-            cities = cities[['provinceName', 'cityName'] +
-                            self.count_cols + ['latitude', 'longitude']]
-            provinces_df = provinces_df.append(cities, ignore_index=True)
+        ms = MAPPER_SERVER(missing=self.missing)
+        self.provinceNames = city_df['provinceName'].unique().tolist()
+        # Add latitude and longtitude in one batch
+        names = city_df['provinceName'] + ' ' + city_df['cityName']
+        latlng = ms.checkout_many(names).to_numpy(dtype=np.float32)
         ms.solid_memory()
-        self.provinces_df = provinces_df.set_index('provinceName',  drop=False)
+        self.index = ms.spatial_index()
+        # Filter and order columns, provinceName shares categories of raw_df
+        provinces_df = city_df[['provinceName', 'cityName'] + self.count_cols]
+        provinces_df = compactDF(provinces_df, self.count_cols,
+                                 province_dtype=self.raw_df['provinceName'].dtype)
+        provinces_df['latitude'] = latlng[:, 0]
+        provinces_df['longitude'] = latlng[:, 1]
+        self.provinces_df = provinces_df
         logging.info('New provinces_df prepared.')
 
-    def draw(self):
+    def draw(self, HTML_FILENAME='index.html', split=False, lazy=False, show=True, cache=None):
         draw(self.country_df,
              self.countryName,
              self.provinces_df,
-             self.provinceNames)
+             self.provinceNames,
+             HTML_FILENAME=HTML_FILENAME,
+             split=split,
+             lazy=lazy,
+             show=show,
+             cache=cache,
+             colors=self.colors)
+
+    def draw_timeline(self, manager, start=None, end=None, daily=True, HTML_FILENAME='timeline.html', split=False):
+        """
+        Draw animated timeline across snapshots of inventory.
+        inputs:
+            manager: INV_MANAGER of the inventory
+            start: string of first date in format of yyyymmdd, None for no limit
+            end: string of last date in format of yyyymmdd, None for no limit
+            daily: if only use the last snapshot of each day
+            HTML_FILENAME: filename of output html file
+            split: if write plotly.js and figure data as separate files
+        """
+        cube = manager.get_cube('city', start=start, end=end, daily=daily)
+        if cube.empty:
+            raise ValueError(f'No snapshots between {start} and {end}.')
+        draw_timeline(cube['confirmedCount'],
+                      HTML_FILENAME=HTML_FILENAME,
+                      split=split)
 
 
-colorscale = px.colors.carto.Redor
-showscale = False
-size = 9
+def _categories(values):
+    # Categories of names, strings are interned to be shared between snapshots
+    return pd.CategoricalDtype([sys.intern(e) if isinstance(e, str) else e
+                                for e in values.dropna().unique()])
+
 
+def compactDF(df, count_cols, province_dtype=None):
+    """
+    Compact dtypes of df.
+    Names are categorical, counts are int32, missing counts are taken as 0.
+    inputs:
+        df: DataFrame with provinceName, and optionally cityName
+        count_cols: count cols of df
+        province_dtype: CategoricalDtype of provinceName, shared with another
+                        frame, made from df if None
+    outputs:
+        df: compacted DataFrame, indexed by provinceName
+    """
+    columns = dict()
+    for col in df.columns:
+        values = df[col]
+        if col in count_cols:
+            values = pd.to_numeric(values, errors='coerce')
+            values = values.fillna(0).astype(np.int32)
+        elif col == 'provinceName':
+            values = values.astype(province_dtype or _categories(values))
+        elif col == 'cityName':
+            values = values.astype(_categories(values))
+        columns[col] = values.array
+    index = pd.CategoricalIndex(columns['provinceName'], name='provinceName')
+    return pd.DataFrame(columns, index=index)
 
-def draw(country_df, countryName, provinces_df, provinceNames, colorscale=colorscale, showscale=showscale, size=size):
 
-    scatter_traces, bar_traces, table_traces, country_name = setup_traces(
-        country_df, countryName, provinces_df, provinceNames)
+colorscale = px.colors.carto.Redor
+showscale = False
+size = 9
 
-    buttons = setup_buttons(provinceNames, countryName,
-                            scatter_traces, country_name)
 
-    draw_plotly(scatter_traces, bar_traces, table_traces, buttons,
-                provinceNames, provinces_df, countryName, country_name)
+# Page of split output, runs script with config of the page
+SPLIT_HTML_TEMPLATE = """<html>
+<head><meta charset="utf-8" /></head>
+<body>
+    <div id="ncov-map" style="height:100%; width:100%;"></div>
+    <script src="{plotlyjs}"></script>
+    <script>
+        const config = {config};
+        {script}
+    </script>
+</body>
+</html>
+"""
+# Fetch figure from data sidecar
+SPLIT_SCRIPT = """
+        fetch(config.sidecar)
+            .then(response => response.json())
+            .then(fig => Plotly.newPlot('ncov-map', fig.data, fig.layout,
+                                        {responsive: true}));
+"""
+# Fetch country view from data sidecar,
+# and traces of province on first click of its button
+LAZY_SCRIPT = """
+        const gd = document.getElementById('ncov-map');
+        const loaded = {};
+        async function showProvince(button) {
+            const prov = button.label;
+            const visible = gd.data.map((trace, i) => false);
+            if (prov in config.provinces) {
+                const info = config.provinces[prov];
+                if (!(prov in loaded)) {
+                    const response = await fetch(info.file);
+                    const traces = await response.json();
+                    await Plotly.addTraces(gd, traces);
+                    loaded[prov] = traces.map(
+                        (trace, i) => gd.data.length - traces.length + i);
+                    visible.push(...traces.map(trace => false));
+                }
+                visible[info.scatter] = true;
+                loaded[prov].forEach(i => visible[i] = true);
+            } else {
+                config.country.forEach(i => visible[i] = true);
+            }
+            Plotly.update(gd, {visible: visible}, {title: button.args[1].title});
+        }
+        fetch(config.sidecar)
+            .then(response => response.json())
+            .then(fig => Plotly.newPlot('ncov-map', fig.data, fig.layout,
+                                        {responsive: true}))
+            .then(() => gd.on('plotly_buttonclicked',
+                              event => showProvince(event.button)));
+"""
+PLOTLYJS_FILENAME = 'plotly.min.js'
+# Figure skeletons of province sets, see figure_of
+SKELETON_CACHE_SIZE = 8
+_skeletons = OrderedDict()
 
 
-def setup_traces(country_df, countryName, provinces_df, provinceNames, colorscale=colorscale, showscale=showscale, size=size):
+def draw(country_df, countryName, provinces_df, provinceNames, colorscale=colorscale, showscale=showscale, size=size, HTML_FILENAME='index.html', split=False, lazy=False, show=True, cache=None, colors=None):
+    """
+    Draw the map.
+    inputs:
+        country_df, countryName, provinces_df, provinceNames: as figure_of
+        colorscale, showscale, size, colors: style as figure_of
+        HTML_FILENAME: filename of output html file
+        split: if write plotly.js and figure data as separate files
+        lazy: if write traces of provinces as separate files, implies split
+        show: if show the figure in browser
+        cache: RENDER_CACHE to skip painting of unchanged snapshot,
+               None for no cache, lazy output is never cached
+    """
+    # The cached file is the html, or the sidecar of split output
+    key = None
+    if cache is not None and not lazy:
+        colored_df = provinces_df
+        if colors is not None:
+            colored_df = provinces_df.assign(color=colors)
+        key = cache.make_key(country_df, colored_df,
+                             colorscale=colorscale, showscale=showscale,
+                             size=size, split=split)
+        cached_path = sidecar_of(HTML_FILENAME) if split else HTML_FILENAME
+        if cache.fetch(key, cached_path):
+            if split:
+                write_plotlyjs(os.path.dirname(HTML_FILENAME))
+                write_split_page(HTML_FILENAME)
+            return
+
+    fig = figure_of(country_df, countryName, provinces_df, provinceNames,
+                    colorscale=colorscale, showscale=showscale, size=size,
+                    colors=colors)
+    # Lazy output takes traces out of the figure, keep the skeleton intact
+    if lazy:
+        fig = go.Figure(fig)
+    write_figure(fig, provinceNames, HTML_FILENAME=HTML_FILENAME,
+                 split=split, lazy=lazy, show=show)
+
+    if key is not None:
+        cache.store(key, cached_path)
+
+
+def _cities_of(provinces_df, prov):
+    # Cities of prov as DataFrame, even if there is only one
+    cities = provinces_df.loc[prov]
+    if isinstance(cities, pd.Series):
+        cities = pd.DataFrame(cities).T
+    return cities
+
+
+def figure_of(country_df, countryName, provinces_df, provinceNames, colorscale=colorscale, showscale=showscale, size=size, colors=None):
     """
-    Setup traces.
+    Get figure of the map.
+    The skeleton of figure is built once for a set of provinces and style,
+    and only the data arrays are patched for each snapshot.
     inputs:
         country_df: DataFrame of country
         countryName: Name of country
@@ -126,102 +366,122 @@ def setup_traces(country_df, countryName, provinces_df, provinceNames, colorscal
         colorscale: Color map for Scattermapbox
         showscale: Toggle of showing colormap
         size: Marker size of Scattermapbox
+        colors: Marker color of each row of provinces_df,
+                None for log of confirmedCount
     outputs:
-        scatter_traces: a dict for scattermapbox, counts of every city
-        bar_traces: a dict for bar, counts of each city in province and whole country
-        table_traces: a dict for table, raw table of each province and whole country
-        country_name: Country name with counting
+        fig: plotly figure, shared with later calls of the same skeleton
     """
-    scatter_traces = dict()
-    bar_traces = dict()
-    table_traces = dict()
-    country_name = '{} {}例'.format(
-        countryName, country_df.confirmedCount.sum())
-
-    # for each province
-    # 1. fetch its cities
-    # 2. setup its scatter
-    # 3. save the scatter into scatter_traces
-    log_confirmedCount = np.log10(provinces_df.confirmedCount.values + 1)
-    cmax, cmin = log_confirmedCount.max(), log_confirmedCount.min()
+    key = (tuple(provinceNames), countryName,
+           tuple(country_df.columns), tuple(provinces_df.columns),
+           tuple(colorscale), showscale, size)
+    fig = _skeletons.get(key)
+    if fig is None:
+        fig = build_skeleton(provinceNames, countryName,
+                             country_df.columns, provinces_df.columns,
+                             colorscale=colorscale, showscale=showscale,
+                             size=size)
+        _skeletons[key] = fig
+        while len(_skeletons) > SKELETON_CACHE_SIZE:
+            _skeletons.popitem(last=False)
+    _skeletons.move_to_end(key)
+    patch_figure(fig, country_df, countryName, provinces_df, provinceNames,
+                 colors=colors)
+    return fig
+
+
+@span('painter.build_skeleton')
+def build_skeleton(provinceNames, countryName, country_columns, city_columns, colorscale=colorscale, showscale=showscale, size=size):
+    """
+    Build figure without data.
+    Traces are [scattermapbox] + [bar] + [table] of provinces,
+    and the bar and table of whole country.
+    inputs:
+        provinceNames: Name list of provinces
+        countryName: Name of country
+        country_columns: columns of country_df
+        city_columns: columns of provinces_df
+        colorscale, showscale, size: style as figure_of
+    outputs:
+        fig: plotly figure, to be filled by patch_figure
+    """
+    scatter_traces, bar_traces, table_traces = dict(), dict(), dict()
     for prov in provinceNames:
-        # print(prov, end=', ')
-
-        # fetch cities
-        cities = provinces_df.loc[prov]
-        if isinstance(cities, pd.Series):
-            cities = pd.DataFrame(cities).T
-
-        # setup scatter
-        # prepare marker for each city
-        marker = go.scattermapbox.Marker(
-            color=np.log10(cities['confirmedCount'].astype(np.float)+1),
-            cmax=cmax,
-            cmin=cmin,
-            colorscale=colorscale,
-            size=size,
-            showscale=showscale
-        )
-        # setup scatter
-        scatter = go.Scattermapbox(
-            lat=cities['latitude'],
-            lon=cities['longitude'],
-            text=cities.provinceName + '-' + cities.cityName +
-            '-' + cities.confirmedCount.astype(str),
+        scatter_traces[prov] = go.Scattermapbox(
             mode='markers',
-            marker=marker,
-            name='{} {}例'.format(prov, cities.confirmedCount.sum()),
-            visible=True,
-        )
-        # setup bar
-        bar = go.Bar(
-            x=cities.cityName,
-            y=cities.confirmedCount,
-            name='',
-            visible=False,
-        )
-        # setup table
-        table = go.Table(
-            header=dict(
-                values=cities.columns,
-                font=dict(size=10),
-                align='left'),
-            cells=dict(
-                values=[cities[k].tolist() for k in cities.columns],
-                align='left'),
-            visible=False,
-        )
-
-        # save the scatter
-        scatter_traces[prov] = scatter
-        bar_traces[prov] = bar
-        table_traces[prov] = table
-
-    # add global bar
-    bar_traces[countryName] = go.Bar(
-        x=country_df.provinceName,
-        y=country_df.confirmedCount,
-        text=country_df.confirmedCount.tolist(),
-        name='',
-        visible=True
-    )
-
-    # add global table
+            marker=go.scattermapbox.Marker(colorscale=colorscale,
+                                           size=size,
+                                           showscale=showscale),
+            visible=True)
+        bar_traces[prov] = go.Bar(name='', visible=False)
+        table_traces[prov] = go.Table(
+            header=dict(values=list(city_columns),
+                        font=dict(size=10),
+                        align='left'),
+            cells=dict(align='left'),
+            visible=False)
+    bar_traces[countryName] = go.Bar(name='', visible=True)
     table_traces[countryName] = go.Table(
-        header=dict(
-            values=country_df.columns,
-            font=dict(size=10),
-            align='left'),
-        cells=dict(
-            values=[country_df[k].tolist() for k in country_df.columns],
-            align='left'),
-        visible=True,
-    )
-
-    # print('done.')
-    return scatter_traces, bar_traces, table_traces, country_name
-
-
+        header=dict(values=list(country_columns),
+                    font=dict(size=10),
+                    align='left'),
+        cells=dict(align='left'),
+        visible=True)
+    # Titles of buttons are patched
+    buttons = setup_buttons(provinceNames, countryName, scatter_traces, None)
+    return setup_figure(scatter_traces, bar_traces, table_traces, buttons,
+                        provinceNames, countryName)
+
+
+@span('painter.patch_figure')
+def patch_figure(fig, country_df, countryName, provinces_df, provinceNames, colors=None):
+    """
+    Patch data arrays of figure built by build_skeleton, in place.
+    inputs:
+        fig: plotly figure built by build_skeleton
+        country_df, countryName, provinces_df, provinceNames: as figure_of
+        colors: as figure_of
+    """
+    n = len(provinceNames)
+    if colors is None:
+        colors = np.log10(provinces_df.confirmedCount.to_numpy(dtype=float)+1)
+    cmax, cmin = np.nanmax(colors), np.nanmin(colors)
+    rows = provinces_df.index.to_numpy()
+    country_name = '{} {}例'.format(
+        countryName, country_df.confirmedCount.sum())
+    buttons = fig.layout.updatemenus[0].buttons
+    for i, prov in enumerate(provinceNames):
+        cities = _cities_of(provinces_df, prov)
+        scatter = fig.data[i]
+        scatter.lat = cities['latitude']
+        scatter.lon = cities['longitude']
+        scatter.text = cities.provinceName.astype(str) + '-' + \
+            cities.cityName.astype(str) + '-' + cities.confirmedCount.astype(str)
+        scatter.marker.color = colors[rows == prov]
+        scatter.marker.cmax = cmax
+        scatter.marker.cmin = cmin
+        name = '{} {}例'.format(prov, cities.confirmedCount.sum())
+        scatter.name = name
+        bar = fig.data[n + i]
+        bar.x = cities.cityName
+        bar.y = cities.confirmedCount
+        fig.data[2 * n + i].cells.values = [cities[k].tolist()
+                                            for k in cities.columns]
+        buttons[i + 1].args = [buttons[i + 1].args[0],
+                               {'title': name}]
+    bar = fig.data[3 * n]
+    bar.x = country_df.provinceName
+    bar.y = country_df.confirmedCount
+    bar.text = country_df.confirmedCount.tolist()
+    fig.data[3 * n + 1].cells.values = [country_df[k].tolist()
+                                        for k in country_df.columns]
+    buttons[0].args = [buttons[0].args[0], {'title': country_name}]
+    fig.update_mapboxes(center=go.layout.mapbox.Center(
+        lat=provinces_df.latitude.mean(),
+        lon=provinces_df.longitude.mean()))
+    fig.update_layout(title_text=country_name)
+
+
+@span('painter.setup_buttons')
 def setup_buttons(provinceNames, countryName, scatter_traces, country_name):
     """
     Setup button for each province.
@@ -274,20 +534,215 @@ def setup_buttons(provinceNames, countryName, scatter_traces, country_name):
     return buttons
 
 
-def draw_plotly(scatter_traces, bar_traces, table_traces, buttons, provinceNames, provinces_df, countryName, country_name, HTML_FILENAME='index.html'):
+@span('painter.draw_timeline')
+def draw_timeline(counts, colorscale=colorscale, size=size, HTML_FILENAME='timeline.html', split=False):
+    """
+    Draw animated timeline of confirmedCount of cities.
+    Positions, names and layout are in the base trace only,
+    each frame carries counts and colors of one snapshot,
+    and snapshots without any change are dropped.
+    inputs:
+        counts: DataFrame of confirmedCount, indexed by snapshot time,
+                columns are 'provinceName cityName', like INV_MANAGER.get_cube
+        colorscale: Color map for Scattermapbox
+        size: Marker size of Scattermapbox
+        HTML_FILENAME: filename of output html file
+        split: if write plotly.js and figure data as separate files
+    """
+    # Drop cities never counted, and snapshots without change
+    counts = counts.dropna(axis=1, how='all').fillna(0)
+    if counts.empty:
+        raise ValueError('No snapshots of counts to draw.')
+    changed = counts.diff().abs().sum(axis=1) > 0
+    changed.iloc[:1] = True
+    counts = counts[changed]
+
+    # Static geometry, computed once
+    ms = MAPPER_SERVER()
+    latlng = ms.checkout_many(counts.columns)
+    ms.solid_memory()
+    located = latlng['latitude'].notna().to_numpy()
+    counts = counts.loc[:, located]
+    latlng = latlng[located]
+
+    values = counts.to_numpy(dtype=np.int64)
+    colors = np.round(np.log10(values + 1), 3)
+    cmax, cmin = colors.max(), colors.min()
+    labels = [e.strftime('%Y-%m-%d %H:%M') for e in counts.index]
+
+    scatter = go.Scattermapbox(
+        lat=latlng['latitude'],
+        lon=latlng['longitude'],
+        text=[e.replace(' ', '-') for e in counts.columns],
+        customdata=values[-1],
+        hovertemplate='%{text}-%{customdata}<extra></extra>',
+        mode='markers',
+        marker=go.scattermapbox.Marker(
+            color=colors[-1],
+            cmax=cmax,
+            cmin=cmin,
+            colorscale=colorscale,
+            size=size),
+    )
+
+    # Frames only carry the arrays changing between snapshots
+    frames = [go.Frame(name=label,
+                       traces=[0],
+                       data=[dict(type='scattermapbox',
+                                  customdata=value,
+                                  marker=dict(color=color))])
+              for label, value, color in zip(labels, values, colors)]
+
+    steps = [dict(label=label,
+                  method='animate',
+                  args=[[label], dict(mode='immediate',
+                                      frame=dict(duration=0, redraw=True),
+                                      transition=dict(duration=0))])
+             for label in labels]
+
+    fig = go.Figure(data=[scatter], frames=frames)
+    fig.update_layout(
+        title_text='全国 {}'.format(labels[-1]),
+        height=800,
+        mapbox=dict(
+            accesstoken=profiles.mapbox_ak,
+            zoom=3,
+            center=dict(lat=latlng['latitude'].mean(),
+                        lon=latlng['longitude'].mean())),
+        sliders=[dict(active=len(steps) - 1, steps=steps)],
+        updatemenus=[dict(
+            type='buttons',
+            showactive=False,
+            buttons=[dict(label='Play',
+                          method='animate',
+                          args=[None, dict(frame=dict(duration=300,
+                                                      redraw=True),
+                                           fromcurrent=True)])])],
+    )
+
+    if split:
+        write_split_html(fig, HTML_FILENAME)
+    else:
+        atomicWrite(HTML_FILENAME, fig.write_html, mode='w')
+    logging.info(f'Write timeline of {len(frames)} frames.')
+
+
+def write_plotlyjs(dirname):
+    """
+    Write shared plotly.js into dirname, if not exists.
+    inputs:
+        dirname: dir of output html files
+    """
+    plotlyjs_path = os.path.join(dirname, PLOTLYJS_FILENAME)
+    if not os.path.exists(plotlyjs_path):
+        atomicWrite(plotlyjs_path,
+                    lambda f: f.write(plotly.offline.get_plotlyjs()),
+                    mode='w')
+        logging.info(f'Write shared {plotlyjs_path}.')
+
+
+def write_split_html(fig, HTML_FILENAME, script=SPLIT_SCRIPT, config=None):
     """
-    Plot plotly graph.
+    Write figure as a page, a data sidecar and a shared plotly.js.
+    plotly.js is written once in the dir of HTML_FILENAME,
+    and reused by every page in the dir.
+    The page fetches the sidecar, so it should be served over http.
     inputs:
-        scatter_traces: a dict for scattermapbox, counts of every city
-        bar_traces: a dict for bar, counts of each city in province and whole country
-        table_traces: a dict for table, raw table of each province and whole country
-        buttons:buttons paired with provinces
+        fig: plotly figure
+        HTML_FILENAME: filename of output html file
+        script: javascript of the page
+        config: dict of extra config of the page
+    yield:
+        Write HTML_FILENAME, its .json sidecar and plotly.min.js
+    """
+    write_plotlyjs(os.path.dirname(HTML_FILENAME))
+
+    sidecar_path = sidecar_of(HTML_FILENAME)
+    atomicWrite(sidecar_path,
+                lambda f: f.write(plotly.io.to_json(fig, pretty=False)),
+                mode='w')
+    write_split_page(HTML_FILENAME, script=script, config=config)
+
+
+def sidecar_of(HTML_FILENAME):
+    """
+    Get path of data sidecar of split output.
+    inputs:
+        HTML_FILENAME: filename of output html file
+    outputs:
+        sidecar_path: path of the sidecar json file
+    """
+    return os.path.splitext(HTML_FILENAME)[0] + '.json'
+
+
+def write_split_page(HTML_FILENAME, script=SPLIT_SCRIPT, config=None):
+    """
+    Write page of split output, which fetches its sidecar.
+    inputs:
+        HTML_FILENAME: filename of output html file
+        script: javascript of the page
+        config: dict of extra config of the page
+    """
+    sidecar_path = sidecar_of(HTML_FILENAME)
+    config = dict(config or dict(), sidecar=os.path.basename(sidecar_path))
+    html = SPLIT_HTML_TEMPLATE.format(plotlyjs=PLOTLYJS_FILENAME,
+                                      config=json.dumps(config),
+                                      script=script)
+    atomicWrite(HTML_FILENAME, lambda f: f.write(html), mode='w')
+    logging.info(f'Write {HTML_FILENAME} with sidecar {sidecar_path}.')
+
+
+def write_lazy_html(fig, provinceNames, HTML_FILENAME):
+    """
+    Write figure as split output, only the country view is embedded.
+    Bar and table traces of each province are written as small json files,
+    and loaded by the page when the button of the province is clicked.
+    inputs:
+        fig: plotly figure built by figure_of
+        provinceNames: Name list of provinces
+        HTML_FILENAME: filename of output html file
+    yield:
+        Write files as write_split_html, and a dir of province traces
+    """
+    n = len(provinceNames)
+    # Traces are [scattermapbox] + [bar] + [table] + [global bar, global table]
+    data = fig.data
+    provinces_dir = os.path.splitext(HTML_FILENAME)[0] + '_provinces'
+    os.makedirs(provinces_dir, exist_ok=True)
+    provinces = dict()
+    for i, prov in enumerate(provinceNames):
+        traces = [data[n + i].to_plotly_json(), data[2 * n + i].to_plotly_json()]
+        path = os.path.join(provinces_dir, f'{i}.json')
+        atomicWrite(path,
+                    lambda f: json.dump(traces, f, separators=(',', ':'),
+                                        cls=plotly.utils.PlotlyJSONEncoder),
+                    mode='w')
+        provinces[prov] = {'file': '/'.join([os.path.basename(provinces_dir),
+                                             f'{i}.json']),
+                           'scatter': i}
+
+    # Keep scatters and global traces, buttons are handled by the page
+    fig.data = data[:n] + data[3 * n:]
+    for button in fig.layout.updatemenus[0].buttons:
+        button.method = 'skip'
+    config = {'provinces': provinces,
+              'country': list(range(n + 2))}
+    write_split_html(fig, HTML_FILENAME, script=LAZY_SCRIPT, config=config)
+
+
+def setup_figure(scatter_traces, bar_traces, table_traces, buttons, provinceNames, countryName):
+    """
+    Setup figure of traces, without center of map and title.
+    inputs:
+        scatter_traces: a dict for scattermapbox of each province
+        bar_traces: a dict for bar of each province and whole country
+        table_traces: a dict for table of each province and whole country
+        buttons: buttons paired with provinces
         provinceNames: Name list of provinces
-        provinces_df: DataFrame containing counts of cities
         countryName: Name of country
-        country_name: Country name with counting
+    outputs:
+        fig: plotly figure
     """
-
     fig = plotly.subplots.make_subplots(
         rows=2, cols=2,
         shared_xaxes=False,
@@ -320,9 +775,6 @@ def draw_plotly(scatter_traces, bar_traces, table_traces, buttons, provinceNames
         bearing=0,
         pitch=0,
         zoom=2,
-        center=go.layout.mapbox.Center(
-            lat=provinces_df.latitude.mean(),
-            lon=provinces_df.longitude.mean())
     )
 
     fig.update_layout(
@@ -331,7 +783,6 @@ def draw_plotly(scatter_traces, bar_traces, table_traces, buttons, provinceNames
         hovermode='closest',
         # mapbox=mapbox,
         clickmode='event',
-        title_text=country_name,
         updatemenus=[go.layout.Updatemenu(
             active=0,
             buttons=buttons
@@ -342,5 +793,23 @@ def draw_plotly(scatter_traces, bar_traces, table_traces, buttons, provinceNames
     fig.update_layout(yaxis={'title_text': 'Count in log',
                              'title_standoff': 0})
     fig.layout.update({'height': 800})
-    fig.write_html(HTML_FILENAME)
-    fig.show()
+    return fig
+
+
+def write_figure(fig, provinceNames, HTML_FILENAME='index.html', split=False, lazy=False, show=True):
+    """
+    Write figure of the map.
+    inputs:
+        fig: plotly figure of figure_of
+        provinceNames: Name list of provinces
+        HTML_FILENAME, split, lazy, show: output as draw
+    """
+    with span('painter.write_html'):
+        if lazy:
+            write_lazy_html(fig, provinceNames, HTML_FILENAME)
+        elif split:
+            write_split_html(fig, HTML_FILENAME)
+        else:
+            atomicWrite(HTML_FILENAME, fig.write_html, mode='w')
+    if show:
+        fig.show()
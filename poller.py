@@ -0,0 +1,168 @@
+"""
+Long running poller of REMOTE_URL.
+A pooled session sends conditional requests with ETag and Last-Modified,
+and a snapshot is saved only when the hash of parsed areaStat changes.
+Polls are spaced by a jittered interval, failures back off exponentially.
+    STATE_NAME: name of state file of poller in inventory dir
+Usage:
+    python poller.py [--url URL] [--interval 600] [--max-polls N]
+"""
+
+import os
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+import logging
+from local_profiles import profiles
+from local_toolbox import parseAreaStat, atomicWrite
+from instrument import span, count
+
+STATE_NAME = 'poller_state.json'
+
+
+def hashAreaStat(areaStat):
+    """
+    Hash parsed areaStat, independent of formatting of the page.
+    inputs:
+        areaStat: list of dict of provinces
+    outputs:
+        digest: hex digest of areaStat
+    """
+    text = json.dumps(areaStat, sort_keys=True, ensure_ascii=False,
+                      separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class POLLER():
+    def __init__(self, url=None, interval=600, jitter=0.2, timeout=30,
+                 max_backoff=3600):
+        """
+        Builtin init method.
+        inputs:
+            url: url to poll, profiles.remote_url as default
+            interval: seconds between polls
+            jitter: relative jitter of interval
+            timeout: seconds of timeout of requests
+            max_backoff: max seconds of backoff after failures
+        """
+        import requests
+        logging.info('POLLER starts.')
+        self.url = url or profiles.remote_url
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=1, max_retries=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.state_path = os.path.join(profiles.inventory_dir, STATE_NAME)
+        self._read_state()
+
+    def _read_state(self):
+        """
+        Read state of last poll.
+        yield:
+            self.state: dict of etag, last_modified and hash
+        """
+        self.state = {'etag': None, 'last_modified': None, 'hash': None}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                self.state.update(json.load(f))
+
+    def _solid_state(self):
+        atomicWrite(self.state_path,
+                    lambda f: json.dump(self.state, f),
+                    mode='w')
+
+    @span('poller.poll')
+    def poll_once(self):
+        """
+        Poll url once, save snapshot if changed.
+        outputs:
+            fpath: path of saved snapshot, None if not changed
+        """
+        # Saving uses the HTTP free part of fetch
+        from fetch_last_counts import save
+
+        headers = dict()
+        if self.state['etag']:
+            headers['If-None-Match'] = self.state['etag']
+        if self.state['last_modified']:
+            headers['If-Modified-Since'] = self.state['last_modified']
+        response = self.session.get(self.url, headers=headers,
+                                    timeout=self.timeout)
+        count('network.fetch')
+        if response.status_code == 304:
+            count('poller.not_modified')
+            logging.info('Poll: not modified.')
+            return None
+        response.raise_for_status()
+
+        text = response.content.decode()
+        areaStat = parseAreaStat(text)
+        digest = hashAreaStat(areaStat)
+        self.state['etag'] = response.headers.get('ETag')
+        self.state['last_modified'] = response.headers.get('Last-Modified')
+        if digest == self.state['hash']:
+            logging.info('Poll: areaStat not changed.')
+            count('poller.unchanged')
+            self._solid_state()
+            return None
+
+        fpath = save(text, areaStat)
+        self.state['hash'] = digest
+        self._solid_state()
+        logging.info(f'Poll: areaStat changed, saved {fpath}.')
+        return fpath
+
+    def _jittered(self, seconds):
+        return seconds * (1 + self.jitter * (2 * random.random() - 1))
+
+    async def run(self, max_polls=None):
+        """
+        Poll url until max_polls, the blocking request runs in executor.
+        inputs:
+            max_polls: number of polls, None for polling forever
+        outputs:
+            saved: list of paths of saved snapshots
+        """
+        loop = asyncio.get_running_loop()
+        saved = []
+        failures = 0
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                fpath = await loop.run_in_executor(None, self.poll_once)
+                failures = 0
+                if fpath is not None:
+                    saved.append(fpath)
+                delay = self._jittered(self.interval)
+            except Exception as err:
+                failures += 1
+                delay = self._jittered(min(self.max_backoff,
+                                           self.interval * 2 ** failures))
+                logging.error(f'Poll failed {failures} times: {repr(err)}')
+                print(f'Poll failed: {repr(err)}, retry in {delay:.0f}s.')
+            if max_polls is None or polls < max_polls:
+                await asyncio.sleep(delay)
+        return saved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default=None,
+                        help='url to poll, REMOTE_URL as default')
+    parser.add_argument('--interval', type=float, default=600,
+                        help='seconds between polls')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='relative jitter of interval')
+    parser.add_argument('--max-polls', type=int, default=None,
+                        help='number of polls, forever as default')
+    args = parser.parse_args()
+    poller = POLLER(url=args.url, interval=args.interval, jitter=args.jitter)
+    saved = asyncio.run(poller.run(max_polls=args.max_polls))
+    print(f'{len(saved)} snapshots saved.')
@@ -0,0 +1,128 @@
+"""
+Render cache of painted maps.
+Rendered files are kept by a hash of the snapshot content, the coordinates
+of the geocode memory used by it, and the style of painting,
+so unchanged snapshots are linked to the existing output instead of plotting.
+Least recently used entries are evicted when the cache is too large.
+    RENDER_CACHE_DIR: dir of cached files
+    RENDER_VERSION: version of rendering, change it to invalidate the cache
+"""
+
+import os
+import hashlib
+import logging
+import pandas as pd
+from instrument import count
+
+RENDER_CACHE_DIR = 'render_cache'
+RENDER_VERSION = 1
+
+
+def _link(src, dst):
+    # Link src to dst atomically, copy if hard link is not supported
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                fdst.write(fsrc.read())
+        os.replace(tmp, dst)
+    finally:
+        # Rename between links of one inode does nothing, tmp is left
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class RENDER_CACHE():
+    def __init__(self, dir=RENDER_CACHE_DIR, max_entries=500, max_bytes=2 ** 30):
+        """
+        Builtin init method.
+        inputs:
+            dir: dir of cached files
+            max_entries: max number of cached files
+            max_bytes: max total size of cached files
+        """
+        self.dir = dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(self.dir, exist_ok=True)
+
+    def make_key(self, country_df, provinces_df, **style):
+        """
+        Make key of a rendering.
+        inputs:
+            country_df: DataFrame of country
+            provinces_df: DataFrame containing counts and coordinates of cities
+            style: parameters of painting, like colorscale, size and showscale
+        outputs:
+            key: hex digest of the rendering
+        """
+        h = hashlib.sha256(f'render-{RENDER_VERSION}'.encode())
+        for df in [country_df, provinces_df]:
+            h.update(repr(list(df.columns)).encode())
+            h.update(pd.util.hash_pandas_object(df, index=False).values)
+        h.update(repr(sorted(style.items())).encode())
+        return h.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.dir, key + ext)
+
+    def fetch(self, key, path):
+        """
+        Link cached file of key to path.
+        inputs:
+            key: key of the rendering
+            path: path of output file, its extension is part of the key
+        outputs:
+            hit: True if the cached file is linked, False if not cached
+        """
+        cached = self._path(key, os.path.splitext(path)[1])
+        if not os.path.exists(cached):
+            count('render_cache.miss')
+            return False
+        try:
+            _link(cached, path)
+            # Mark as recently used
+            os.utime(cached)
+        except FileNotFoundError:
+            # Evicted by others in the meantime
+            count('render_cache.miss')
+            return False
+        logging.info(f'Render cache hit {key}, link to {path}.')
+        count('render_cache.hit')
+        return True
+
+    def store(self, key, path):
+        """
+        Store rendered file into cache, and evict old entries.
+        inputs:
+            key: key of the rendering
+            path: path of rendered file
+        """
+        _link(path, self._path(key, os.path.splitext(path)[1]))
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove least recently used files beyond max_entries or max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort(reverse=True)
+        total = 0
+        for num, (_, size, path) in enumerate(entries):
+            total += size
+            if num < self.max_entries and total <= self.max_bytes:
+                continue
+            try:
+                os.remove(path)
+                logging.info(f'Render cache evict {path}.')
+            except FileNotFoundError:
+                pass
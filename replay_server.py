@@ -0,0 +1,120 @@
+"""
+Local HTTP stand-in of REMOTE_URL, serving recorded pages.
+The pages are served in turn, each for a number of requests,
+with ETag and Last-Modified, and 304 for matching conditional requests.
+A page is made from the last snapshot of the inventory if no page is given.
+Usage:
+    python replay_server.py [--port 8000] [--repeat 2] [page.html ...]
+"""
+
+import time
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class REPLAY_HANDLER(BaseHTTPRequestHandler):
+    """
+    Handler serving pages of its server.
+    """
+
+    def do_GET(self):
+        body, etag, last_modified = self.server.next_page()
+        if self.not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(last_modified, usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag, last_modified):
+        # If-None-Match takes precedence over If-Modified-Since
+        if 'If-None-Match' in self.headers:
+            return self.headers['If-None-Match'] == etag
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, ValueError):
+                return False
+            return int(last_modified) <= since.timestamp()
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+class REPLAY_SERVER(ThreadingHTTPServer):
+    def __init__(self, pages, repeat=1, address=('127.0.0.1', 0)):
+        """
+        Builtin init method.
+        inputs:
+            pages: list of text of pages, served in turn
+            repeat: number of requests serving each page
+            address: (host, port) to bind, port 0 for any free port
+        """
+        super().__init__(address, REPLAY_HANDLER)
+        now = time.time()
+        self.pages = []
+        for num, page in enumerate(pages):
+            body = page.encode()
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            # Pages are modified one second after another
+            self.pages.append((body, etag, now - len(pages) + num))
+        self.repeat = repeat
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def next_page(self):
+        """
+        Get page of this request, the last page is kept when all served.
+        outputs:
+            body, etag, last_modified: bytes, etag and time of the page
+        """
+        with self.lock:
+            num = min(self.requests // self.repeat, len(self.pages) - 1)
+            self.requests += 1
+        return self.pages[num]
+
+    def start(self):
+        """
+        Serve in a daemon thread.
+        outputs:
+            url: url of the server
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen')
+    parser.add_argument('--repeat', type=int, default=2,
+                        help='number of requests serving each page')
+    parser.add_argument('pages', nargs='*',
+                        help='recorded pages of REMOTE_URL')
+    args = parser.parse_args()
+    pages = []
+    for path in args.pages:
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+    if not pages:
+        from bench_parse import make_default_page
+        pages.append(make_default_page())
+    server = REPLAY_SERVER(pages, repeat=args.repeat,
+                           address=('127.0.0.1', args.port))
+    print(f'Serving {len(pages)} pages at {server.url}')
+    server.serve_forever()
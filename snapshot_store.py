@@ -0,0 +1,598 @@
+"""
+Columnar snapshot store.
+Every snapshot is saved as a NumPy .npz archive holding two flat tables,
+one for provinces and one for cities, next to the legacy json files.
+Most snapshots are saved as deltas, holding only rows changed since the
+previous snapshot, with a full keyframe every KEYFRAME_INTERVAL snapshots.
+    PREFIX: prefix of snapshot filenames
+    STORE_EXT: extension of columnar snapshot files, full keyframes
+    DELTA_EXT: extension of columnar delta files
+    JSON_EXT: extension of legacy json snapshot files
+    KEYFRAME_INTERVAL: max length of a chain of deltas plus its keyframe
+    CACHE_SIZE: number of reconstructed snapshots kept in memory
+"""
+
+import os
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from local_profiles import profiles
+from local_toolbox import atomicWrite
+from json_codec import readColumns, loadMany
+from instrument import span
+
+PREFIX = 'ncov_counts_'
+STORE_EXT = '.npz'
+DELTA_EXT = '.delta.npz'
+JSON_EXT = '.json'
+KEYFRAME_INTERVAL = 24
+CACHE_SIZE = 4
+
+# Keys of the archive are '<table>/<column>',
+# deltas add '<table>~removed/<key column>', '<table>~order/index' and meta
+PROV_TABLE = 'prov'
+CITY_TABLE = 'city'
+META_TABLE = 'meta'
+KEYS = {PROV_TABLE: ['provinceName'],
+        CITY_TABLE: ['provinceName', 'cityName']}
+
+# Reconstructed tables keyed by (path, mtime, size)
+_cache = OrderedDict()
+
+
+def stampOf(name):
+    """
+    Get stamp of snapshot file.
+    inputs:
+        name: filename or path of snapshot, like ncov_counts_20200204-124100.json
+    outputs:
+        stamp: stamp string like 20200204-124100, None if not a snapshot
+    """
+    name = os.path.basename(name)
+    if not name.startswith(PREFIX):
+        return None
+    for ext in [DELTA_EXT, STORE_EXT, JSON_EXT]:
+        if name.endswith(ext):
+            return name[len(PREFIX):-len(ext)]
+    return None
+
+
+def pathOf(stamp, ext=STORE_EXT, dir=None):
+    """
+    Get path of snapshot file.
+    inputs:
+        stamp: stamp string like 20200204-124100
+        ext: extension of the file
+        dir: dir of inventory, profiles.inventory_dir as default
+    outputs:
+        path: path of snapshot file
+    """
+    if dir is None:
+        dir = profiles.inventory_dir
+    return os.path.join(dir, f'{PREFIX}{stamp}{ext}')
+
+
+def listSnapshots(dir=None):
+    """
+    List snapshots in inventory.
+    Keyframe is preferred to delta, and delta to json for the same stamp.
+    inputs:
+        dir: dir of inventory, profiles.inventory_dir as default
+    outputs:
+        snapshots: dict of stamp -> path, sorted by stamp
+    """
+    if dir is None:
+        dir = profiles.inventory_dir
+    snapshots = dict()
+    for name in sorted(os.listdir(dir), key=_rankOf):
+        stamp = stampOf(name)
+        if stamp is None:
+            logging.info(f'Ignore file {name}.')
+            continue
+        if stamp in snapshots:
+            continue
+        snapshots[stamp] = os.path.join(dir, name)
+    return dict(sorted(snapshots.items()))
+
+
+def _rankOf(name):
+    # Preferred format goes first
+    if name.endswith(DELTA_EXT):
+        return 1, name
+    if name.endswith(STORE_EXT):
+        return 0, name
+    return 2, name
+
+
+def _toArray(se):
+    # Numeric columns are kept as they are,
+    # others are stored as unicode strings to avoid pickling.
+    if pd.api.types.is_numeric_dtype(se.dtype):
+        return se.to_numpy()
+    return se.fillna('').astype(str).to_numpy(dtype=str)
+
+
+def splitDF(raw_df):
+    """
+    Split raw_df into flat tables.
+    inputs:
+        raw_df: DataFrame of provinces with nested cities lists
+    outputs:
+        prov_df: DataFrame of provinces without cities
+        city_df: DataFrame of cities with provinceName
+    """
+    # Arrays keep dtypes of columns of provinces
+    return splitColumns({k: raw_df[k].array for k in raw_df.columns})
+
+
+def splitColumns(columns):
+    """
+    Split columns of raw table into flat tables in one pass.
+    inputs:
+        columns: dict of column -> list of provinces with nested cities lists,
+                 as json_codec.readColumns
+    outputs:
+        prov_df: DataFrame of provinces without cities
+        city_df: DataFrame of cities with provinceName
+    """
+    prov_df = pd.DataFrame({k: v for k, v in columns.items() if k != 'cities'})
+    provs, rows = [], []
+    for prov, cities in zip(columns['provinceName'], columns.get('cities', [])):
+        if not isinstance(cities, list):
+            continue
+        for row in cities:
+            if isinstance(row, dict):
+                provs.append(prov)
+                rows.append(row)
+    names = dict.fromkeys(k for row in rows for k in row)
+    city_df = pd.DataFrame({'provinceName': provs,
+                            **{k: [row.get(k) for row in rows] for k in names}})
+    return prov_df, city_df
+
+
+def joinDF(prov_df, city_df):
+    """
+    Join flat tables into raw_df, the inverse of splitDF.
+    inputs:
+        prov_df: DataFrame of provinces without cities
+        city_df: DataFrame of cities with provinceName
+    outputs:
+        raw_df: DataFrame of provinces with nested cities lists
+    """
+    raw_df = prov_df.copy()
+    cities = dict()
+    if len(city_df):
+        city_cols = [e for e in city_df.columns if e != 'provinceName']
+        for prov, df in city_df.groupby('provinceName', sort=False):
+            cities[prov] = df[city_cols].to_dict('records')
+    raw_df['cities'] = [cities.get(prov, []) for prov in raw_df['provinceName']]
+    return raw_df
+
+
+def _storedForm(df):
+    # Table as it is read back from the archive
+    return pd.DataFrame({col: _toArray(df[col]) for col in df.columns})
+
+
+def _archiveOf(tables):
+    # Flat dict of arrays of tables, keyed by '<table>/<column>'
+    arrays = dict()
+    for table, df in tables.items():
+        for col in df.columns:
+            arrays[f'{table}/{col}'] = _toArray(df[col])
+    return arrays
+
+
+def _readArchive(path):
+    # Columns of the archive as dict of table -> dict of column -> array
+    columns = dict()
+    with np.load(path, allow_pickle=False) as npz:
+        for key in npz.files:
+            table, col = key.split('/', 1)
+            columns.setdefault(table, dict())[col] = npz[key]
+    return columns
+
+
+def _cacheKey(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _remember(path, tables):
+    _cache[_cacheKey(path)] = tables
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _diffTable(base, target, keys):
+    """
+    Diff of two tables of the same columns.
+    inputs:
+        base: table of previous snapshot
+        target: table of this snapshot
+        keys: key columns of rows
+    outputs:
+        upserts: rows of target added or changed
+        removed: keys of rows of base not in target
+    """
+    b = base.set_index(keys)
+    t = target.set_index(keys)
+    common = t.index.intersection(b.index)
+    bc, tc = b.loc[common], t.loc[common]
+    same = ((bc == tc) | (bc.isna() & tc.isna())).all(axis=1)
+    changed = common[~same.to_numpy()]
+    upserts = t[~t.index.isin(b.index) | t.index.isin(changed)]
+    removed = b.index[~b.index.isin(t.index)]
+    return (upserts.reset_index()[target.columns],
+            removed.to_frame(index=False))
+
+
+def _applyDelta(base, upserts, removed, order, keys):
+    """
+    Apply delta to table of previous snapshot, the inverse of _diffTable.
+    Changed rows keep their places, added rows are appended,
+    then rows are reordered by order if given.
+    inputs:
+        base: table of previous snapshot
+        upserts: rows added or changed
+        removed: keys of rows removed
+        order: positions of rows of the result, None to keep them
+        keys: key columns of rows
+    outputs:
+        table: table of this snapshot
+    """
+    columns = base.columns
+    b = base.set_index(keys)
+    if len(removed):
+        b = b.drop(index=pd.MultiIndex.from_frame(removed)
+                   if len(keys) > 1 else removed[keys[0]])
+    if len(upserts):
+        u = upserts.set_index(keys)
+        common = u.index[u.index.isin(b.index)]
+        b = b.copy()
+        b.loc[common] = u.loc[common]
+        added = u[~u.index.isin(b.index)]
+        if len(added):
+            b = pd.concat([b, added])
+    table = b.reset_index()[columns]
+    if order is not None:
+        table = table.iloc[order]
+    return table.reset_index(drop=True)
+
+
+def _makeDelta(base_tables, tables):
+    """
+    Make delta of tables against tables of previous snapshot.
+    inputs:
+        base_tables: dict of table -> table of previous snapshot
+        tables: dict of table -> table of this snapshot, in stored form
+    outputs:
+        delta: dict of table -> DataFrame to archive, None if not encodable
+    """
+    delta = dict()
+    for table, keys in KEYS.items():
+        base, target = base_tables[table], tables[table]
+        if (list(base.columns) != list(target.columns)
+                or not (base.dtypes == target.dtypes).all()
+                or not set(keys).issubset(target.columns)
+                or base.duplicated(keys).any()
+                or target.duplicated(keys).any()):
+            return None
+        upserts, removed = _diffTable(base, target, keys)
+        applied = _applyDelta(base, upserts, removed, None, keys)
+        delta[table] = upserts
+        delta[f'{table}~removed'] = removed
+        if not applied[keys].equals(target[keys]):
+            index = pd.MultiIndex.from_frame(applied[keys])
+            order = index.get_indexer(pd.MultiIndex.from_frame(target[keys]))
+            delta[f'{table}~order'] = pd.DataFrame({'index': order.astype(np.int32)})
+            applied = applied.iloc[order].reset_index(drop=True)
+        # Never store a delta not reproducing the snapshot
+        if not applied.equals(target):
+            return None
+    return delta
+
+
+@span('snapshot.write')
+def writeTables(prov_df, city_df, path, base_path=None):
+    """
+    Write flat tables into columnar file atomically.
+    inputs:
+        prov_df: DataFrame of provinces without cities
+        city_df: DataFrame of cities with provinceName
+        path: path of columnar file
+        base_path: path of previous snapshot, write delta against it if given,
+                   the path should end with DELTA_EXT then
+    outputs:
+        path: path of written file, keyframe path if delta is not encodable
+    yield:
+        Write columnar file on path
+    """
+    tables = {PROV_TABLE: _storedForm(prov_df),
+              CITY_TABLE: _storedForm(city_df)}
+    delta = None
+    if base_path is not None:
+        delta = _makeDelta(dict(zip([PROV_TABLE, CITY_TABLE],
+                                    _readTables(base_path))), tables)
+        if delta is None:
+            logging.info('Tables changed in layout, write keyframe.')
+            path = path[:-len(DELTA_EXT)] + STORE_EXT
+    if delta is None:
+        arrays = _archiveOf(tables)
+        # A crash never leaves half a file
+        atomicWrite(path, lambda f: np.savez(f, **arrays))
+    else:
+        arrays = _archiveOf(delta)
+        arrays[f'{META_TABLE}/base'] = np.array(stampOf(base_path))
+        arrays[f'{META_TABLE}/depth'] = np.array(_depthOf(base_path) + 1)
+        atomicWrite(path, lambda f: np.savez_compressed(f, **arrays))
+    _remember(path, (tables[PROV_TABLE], tables[CITY_TABLE]))
+    logging.info(f'Save columnar file {path}.')
+    return path
+
+
+def _depthOf(path):
+    # Number of deltas between path and its keyframe
+    if not path.endswith(DELTA_EXT):
+        return 0
+    with np.load(path, allow_pickle=False) as npz:
+        return int(npz[f'{META_TABLE}/depth'])
+
+
+def _baseStampOf(path):
+    # Stamp of base of delta, None for keyframe
+    if not path.endswith(DELTA_EXT):
+        return None
+    with np.load(path, allow_pickle=False) as npz:
+        return str(npz[f'{META_TABLE}/base'])
+
+
+def _dependentsOf(stamp, dir):
+    # Deltas built on stamp, directly or through other deltas,
+    # as dict of stamp -> path in order of stamps
+    dependents = dict()
+    bases = {stamp}
+    for s, path in listSnapshots(dir).items():
+        if s > stamp and _baseStampOf(path) in bases:
+            dependents[s] = path
+            bases.add(s)
+    return dependents
+
+
+def _previousOf(stamp, dir):
+    # Path of the last columnar snapshot before stamp, None if not found
+    previous = None
+    for s, path in listSnapshots(dir).items():
+        if s >= stamp:
+            break
+        previous = path
+    if previous is None or not previous.endswith(STORE_EXT):
+        return None
+    return previous
+
+
+def writeSnapshot(raw_df, stamp, dir=None, delta=True, rebase=True):
+    """
+    Write raw_df into columnar store.
+    Deltas built on an existing stamp are re-encoded on its new content,
+    and checked to read back unchanged.
+    inputs:
+        raw_df: DataFrame of provinces with nested cities lists
+        stamp: stamp string like 20200204-124100
+        dir: dir of inventory, profiles.inventory_dir as default
+        delta: if write delta against previous snapshot,
+               keyframe is written every KEYFRAME_INTERVAL snapshots anyway
+        rebase: if re-encode deltas built on stamp,
+                False only if the caller rewrites all later snapshots next
+    outputs:
+        path: path of written file
+    """
+    if dir is None:
+        dir = profiles.inventory_dir
+    # Rewriting a stamp changes the base of deltas built on it,
+    # they are read now and re-encoded on its new content
+    dependents = dict()
+    if rebase:
+        dependents = {s: readTables(path)
+                      for s, path in _dependentsOf(stamp, dir).items()}
+    path = _writeStamp(*splitDF(raw_df), stamp, dir, delta)
+    if not dependents:
+        return path
+    paths = {s: _writeStamp(*tables, s, dir, True)
+             for s, tables in dependents.items()}
+    # Check later snapshots read back unchanged, from files not from cache
+    _cache.clear()
+    for s, tables in dependents.items():
+        if not all(a.equals(b) for a, b in zip(readTables(paths[s]), tables)):
+            raise RuntimeError(f'Snapshot {s} changed by rewriting {stamp}.')
+    logging.info(f'Re-encode {len(dependents)} deltas built on {stamp}.')
+    return path
+
+
+def _writeStamp(prov_df, city_df, stamp, dir, delta):
+    # Write tables of stamp, as delta against the previous snapshot if allowed
+    base_path = _previousOf(stamp, dir) if delta else None
+    if base_path is not None and _depthOf(base_path) + 1 >= KEYFRAME_INTERVAL:
+        base_path = None
+    ext = STORE_EXT if base_path is None else DELTA_EXT
+    path = writeTables(prov_df, city_df, pathOf(stamp, ext, dir=dir),
+                       base_path=base_path)
+    # One columnar file for a stamp
+    for other in [STORE_EXT, DELTA_EXT]:
+        stale = pathOf(stamp, other, dir=dir)
+        if stale != path and os.path.exists(stale):
+            os.remove(stale)
+    return path
+
+
+def _readTables(path):
+    # Tables of columnar file, deltas are applied on their bases,
+    # the results are cached and shared, never modify them
+    key = _cacheKey(path)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    columns = _readArchive(path)
+    if META_TABLE not in columns:
+        tables = (pd.DataFrame(columns[PROV_TABLE]),
+                  pd.DataFrame(columns[CITY_TABLE]))
+    else:
+        base_stamp = str(columns[META_TABLE]['base'])
+        base = _readTables(_basePathOf(base_stamp, os.path.dirname(path)))
+        tables = []
+        for table, df in zip([PROV_TABLE, CITY_TABLE], base):
+            order = columns.get(f'{table}~order')
+            tables.append(_applyDelta(
+                df,
+                pd.DataFrame(columns.get(table, dict()), columns=df.columns),
+                pd.DataFrame(columns[f'{table}~removed']),
+                None if order is None else order['index'],
+                KEYS[table]))
+        tables = tuple(tables)
+    _remember(path, tables)
+    return tables
+
+
+def _basePathOf(stamp, dir):
+    # Path of columnar file of base stamp of a delta
+    for ext in [STORE_EXT, DELTA_EXT]:
+        path = pathOf(stamp, ext, dir=dir)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f'Base of delta not found: {stamp}.')
+
+
+@span('snapshot.read')
+def readTables(path):
+    """
+    Read flat tables from snapshot file.
+    Legacy json file is split on the fly,
+    delta file is applied on its base snapshot.
+    inputs:
+        path: path of columnar file, delta file or json file
+    outputs:
+        prov_df: DataFrame of provinces without cities
+        city_df: DataFrame of cities with provinceName
+    """
+    if path.endswith(JSON_EXT):
+        return splitColumns(readColumns(path))
+    prov_df, city_df = _readTables(path)
+    return prov_df.copy(), city_df.copy()
+
+
+def readSnapshot(path):
+    """
+    Read raw_df from columnar file.
+    inputs:
+        path: path of columnar file or delta file
+    outputs:
+        raw_df: DataFrame of provinces with nested cities lists
+    """
+    return joinDF(*readTables(path))
+
+
+def changes(stamp=None, dir=None):
+    """
+    Rows changed in snapshot since the previous one.
+    Delta file is read as it is, other snapshots are compared with the
+    previous one.
+    inputs:
+        stamp: stamp string like 20200204-124100, the last one as default
+        dir: dir of inventory, profiles.inventory_dir as default
+    outputs:
+        prov_df: DataFrame of provinces added or changed,
+                 and keys of removed ones, marked by removed column
+        city_df: DataFrame of cities as prov_df
+    """
+    snapshots = listSnapshots(dir)
+    stamps = list(snapshots)
+    if stamp is None:
+        stamp = stamps[-1]
+    path = snapshots[stamp]
+    idx = stamps.index(stamp)
+    if path.endswith(DELTA_EXT):
+        columns = _readArchive(path)
+        base = _readTables(_basePathOf(str(columns[META_TABLE]['base']),
+                                       os.path.dirname(path)))
+        delta = [(pd.DataFrame(columns.get(table, dict()), columns=df.columns),
+                  pd.DataFrame(columns[f'{table}~removed']))
+                 for table, df in zip([PROV_TABLE, CITY_TABLE], base)]
+    else:
+        tables = readTables(path)
+        if idx == 0:
+            base = [df.iloc[:0] for df in tables]
+        else:
+            base = readTables(snapshots[stamps[idx - 1]])
+        delta = [_diffTable(b, t, KEYS[table])
+                 for table, b, t in zip([PROV_TABLE, CITY_TABLE], base, tables)]
+    results = []
+    for upserts, removed in delta:
+        results.append(pd.concat([upserts.assign(removed=False),
+                                  removed.assign(removed=True)],
+                                 ignore_index=True))
+    return tuple(results)
+
+
+def readAllTables(snapshots):
+    """
+    Read flat tables of many snapshots, keyed by stamp.
+    Snapshots are read in parallel on a process pool, as json_codec.loadMany.
+    inputs:
+        snapshots: dict of stamp -> path of snapshot file
+    outputs:
+        prov_df: DataFrame of provinces with stamp column
+        city_df: DataFrame of cities with stamp column
+    """
+    provs, cities = [], []
+    # Neighbouring snapshots go to the same worker, deltas share their bases
+    tables = loadMany(snapshots.values(), readTables)
+    for stamp, (prov_df, city_df) in zip(snapshots, tables):
+        provs.append(prov_df.assign(stamp=stamp))
+        cities.append(city_df.assign(stamp=stamp))
+    if not provs:
+        return pd.DataFrame(), pd.DataFrame()
+    return (pd.concat(provs, ignore_index=True),
+            pd.concat(cities, ignore_index=True))
+
+
+def importInventory(dir=None, overwrite=False, delta=True):
+    """
+    One-shot importer, convert legacy json files into columnar files.
+    The json files are kept as they are.
+    inputs:
+        dir: dir of inventory, profiles.inventory_dir as default
+        overwrite: if overwrite existing columnar files
+        delta: if write deltas between keyframes
+    outputs:
+        paths: list of written columnar files
+    """
+    if dir is None:
+        dir = profiles.inventory_dir
+    names = dict()
+    for name in sorted(os.listdir(dir)):
+        stamp = stampOf(name)
+        if stamp is None or not name.endswith(JSON_EXT):
+            continue
+        existing = [pathOf(stamp, ext, dir=dir) for ext in [STORE_EXT, DELTA_EXT]]
+        if any(map(os.path.exists, existing)) and not overwrite:
+            logging.info(f'Columnar file exists: {stamp}.')
+            continue
+        names[stamp] = name
+    # Deltas after the last kept snapshot are all rewritten in order,
+    # they need no re-encoding on the way
+    kept = [s for s, path in listSnapshots(dir).items()
+            if s not in names and not path.endswith(JSON_EXT)]
+    last_kept = max(kept, default='')
+    paths = []
+    for stamp, name in names.items():
+        raw_df = pd.DataFrame(readColumns(os.path.join(dir, name)))
+        paths.append(writeSnapshot(raw_df, stamp, dir=dir, delta=delta,
+                                   rebase=last_kept > stamp))
+    logging.info(f'Imported {len(paths)} snapshots.')
+    return paths
+
+
+if __name__ == '__main__':
+    paths = importInventory()
+    print(f'{len(paths)} snapshots imported.')
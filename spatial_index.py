@@ -0,0 +1,318 @@
+"""
+Spatial index of geocoded locations.
+Positions are indexed as 3D unit vectors in a KD-tree, the chord between
+two unit vectors grows with their great circle distance, so radius and
+nearest queries by chord are exact on the sphere.
+scipy cKDTree is used when installed, the KD_TREE of NumPy otherwise.
+    EARTH_RADIUS: mean radius of the earth in km
+    LEAF_SIZE: max number of points in a leaf of the tree
+"""
+
+import heapq
+import logging
+import numpy as np
+import pandas as pd
+from instrument import span, count
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+EARTH_RADIUS = 6371.0
+LEAF_SIZE = 16
+
+# Index of the geocode memory, as (key, index)
+_memory_index = (None, None)
+
+
+def unitVectors(lat, lng):
+    """
+    Unit vectors of positions.
+    inputs:
+        lat: array of latitudes in degrees
+        lng: array of longitudes in degrees
+    outputs:
+        points: array in shape of (n, 3)
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lng, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lng),
+                     np.cos(lat) * np.sin(lng),
+                     np.sin(lat)], axis=-1).reshape(-1, 3)
+
+
+def chordOf(km):
+    # Chord of great circle distance, distances beyond half the earth are capped
+    return 2 * np.sin(np.clip(km / EARTH_RADIUS, 0, np.pi) / 2)
+
+
+def kmOf(chord):
+    # Great circle distance of chord
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+class KD_TREE():
+    """
+    KD-tree of points, split at the median of the widest dim.
+    Nodes are kept in flat lists, leaves hold ranges of self.order.
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        """
+        Builtin init method.
+        inputs:
+            points: array in shape of (n, dims)
+            leaf_size: max number of points in a leaf
+        """
+        self.points = np.asarray(points, dtype=float)
+        self.leaf_size = max(1, leaf_size)
+        self.order = np.arange(len(self.points))
+        self.lo, self.hi, self.ranges, self.children = [], [], [], []
+        if len(self.points):
+            self._build(0, len(self.points))
+
+    def _build(self, start, end):
+        # Build node of order[start:end], return its id
+        node = len(self.ranges)
+        idx = self.order[start:end]
+        pts = self.points[idx]
+        self.lo.append(pts.min(axis=0))
+        self.hi.append(pts.max(axis=0))
+        self.ranges.append((start, end))
+        self.children.append(None)
+        if end - start > self.leaf_size:
+            dim = np.argmax(self.hi[node] - self.lo[node])
+            mid = (end - start) // 2
+            self.order[start:end] = idx[np.argpartition(pts[:, dim], mid)]
+            self.children[node] = (self._build(start, start + mid),
+                                   self._build(start + mid, end))
+        return node
+
+    def _box_distance(self, node, x):
+        # Min distance from x to bounding box of node
+        d = np.maximum(self.lo[node] - x, 0) + np.maximum(x - self.hi[node], 0)
+        return np.sqrt(d @ d)
+
+    def _leaf(self, node, x):
+        # Rows and distances of points in leaf
+        start, end = self.ranges[node]
+        rows = self.order[start:end]
+        return rows, np.linalg.norm(self.points[rows] - x, axis=1)
+
+    def query_ball_point(self, x, r):
+        """
+        Points within r of x.
+        inputs:
+            x: point in shape of (dims,)
+            r: radius
+        outputs:
+            rows: list of rows of points, in no order
+        """
+        found = []
+        stack = [0] if self.ranges else []
+        while stack:
+            node = stack.pop()
+            if self._box_distance(node, x) > r:
+                continue
+            if self.children[node] is None:
+                rows, dist = self._leaf(node, x)
+                found.extend(rows[dist <= r].tolist())
+            else:
+                stack.extend(self.children[node])
+        return found
+
+    def query(self, x, k):
+        """
+        k nearest points of x, visiting nodes from the nearest box.
+        inputs:
+            x: point in shape of (dims,)
+            k: number of points, at most number of points in tree
+        outputs:
+            dist: array of distances in ascending order
+            rows: array of rows of points
+        """
+        best_rows = np.empty(0, dtype=int)
+        best_dist = np.empty(0)
+        heap = [(0.0, 0)] if self.ranges else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if len(best_dist) == k and bound > best_dist[-1]:
+                break
+            if self.children[node] is None:
+                rows, dist = self._leaf(node, x)
+                best_rows = np.concatenate([best_rows, rows])
+                best_dist = np.concatenate([best_dist, dist])
+                keep = np.argsort(best_dist, kind='stable')[:k]
+                best_rows, best_dist = best_rows[keep], best_dist[keep]
+            else:
+                for child in self.children[node]:
+                    heapq.heappush(heap, (self._box_distance(child, x), child))
+        return best_dist, best_rows
+
+
+class SPATIAL_INDEX():
+    """
+    Spatial index of named positions on the earth.
+    Distances are great circle distances in km.
+    """
+
+    @span('spatial.build')
+    def __init__(self, positions, leaf_size=LEAF_SIZE):
+        """
+        Builtin init method.
+        inputs:
+            positions: dict of name -> (lat, lng) in degrees,
+                       like memory of MAPPER_SERVER, unknown positions are skipped
+            leaf_size: max number of points in a leaf of the tree
+        """
+        names, latlng = [], []
+        for name, (lat, lng) in positions.items():
+            if lat is None or lng is None or not np.isfinite([lat, lng]).all():
+                continue
+            names.append(name)
+            latlng.append((lat, lng))
+        self.names = np.array(names, dtype=object)
+        self.latlng = np.array(latlng, dtype=float).reshape(-1, 2)
+        self.rows = dict(zip(names, range(len(names))))
+        self.points = unitVectors(self.latlng[:, 0], self.latlng[:, 1])
+        if cKDTree is not None:
+            self.tree = cKDTree(self.points, leafsize=leaf_size)
+        else:
+            self.tree = KD_TREE(self.points, leaf_size=leaf_size)
+        logging.info(f'Spatial index of {len(names)} positions built.')
+
+    def __len__(self):
+        return len(self.names)
+
+    def position(self, name):
+        """
+        Position of name.
+        inputs:
+            name: name of location
+        outputs:
+            lat, lng: position in degrees, KeyError if not indexed
+        """
+        return tuple(self.latlng[self.rows[name]])
+
+    def _query(self, x, k):
+        # k nearest rows of unit vector x, as arrays for both trees
+        if cKDTree is not None:
+            return self.tree.query(x, k=list(range(1, k + 1)))
+        return self.tree.query(x, k)
+
+    def _series(self, rows, chord):
+        # Distances of rows as Series indexed by name, in ascending order
+        rows = np.asarray(rows, dtype=int)
+        order = np.argsort(chord, kind='stable')
+        return pd.Series(kmOf(np.asarray(chord, dtype=float)[order]),
+                         index=pd.Index(self.names[rows[order]], name='name'),
+                         name='distance')
+
+    def within(self, lat, lng, radius):
+        """
+        Locations within radius of position.
+        inputs:
+            lat, lng: position in degrees
+            radius: radius in km
+        outputs:
+            distances: Series of km indexed by name, nearest first
+        """
+        count('spatial.query')
+        x = unitVectors(lat, lng)[0]
+        rows = np.asarray(self.tree.query_ball_point(x, chordOf(radius)),
+                          dtype=int)
+        chord = np.linalg.norm(self.points[rows] - x, axis=1)
+        return self._series(rows, chord)
+
+    def nearest(self, lat, lng, n=5, among=None):
+        """
+        Nearest locations of position.
+        inputs:
+            lat, lng: position in degrees
+            n: number of locations
+            among: collection of names to choose from, all names if None
+        outputs:
+            distances: Series of km indexed by name, nearest first,
+                       shorter than n if not enough locations
+        """
+        count('spatial.query')
+        x = unitVectors(lat, lng)[0]
+        among = None if among is None else set(among)
+        k = n if among is None else 2 * n
+        while True:
+            k = min(k, len(self))
+            if k == 0:
+                return self._series([], [])
+            chord, rows = self._query(x, k)
+            if among is not None:
+                keep = np.array([e in among for e in self.names[rows]],
+                                dtype=bool)
+                chord, rows = chord[keep], rows[keep]
+            if len(rows) >= n or k == len(self):
+                return self._series(rows[:n], chord[:n])
+            # Too few locations of among, search farther
+            k *= 2
+
+    def neighbors(self, name, radius=None, n=5):
+        """
+        Neighbors of location, the location itself excluded.
+        inputs:
+            name: name of location, KeyError if not indexed
+            radius: radius in km, the n nearest neighbors if None
+            n: number of neighbors if radius is None
+        outputs:
+            distances: Series of km indexed by name, nearest first
+        """
+        lat, lng = self.position(name)
+        if radius is not None:
+            return self.within(lat, lng, radius).drop(name, errors='ignore')
+        return self.nearest(lat, lng, n + 1).drop(name, errors='ignore').iloc[:n]
+
+    def cases_within(self, lat, lng, radius, counts):
+        """
+        Total counts of locations within radius of position.
+        inputs:
+            lat, lng: position in degrees
+            radius: radius in km
+            counts: Series of counts indexed by name,
+                    or DataFrame with names as columns, like city cube
+        outputs:
+            total: total count, or Series of totals of rows of DataFrame
+        """
+        names = self.within(lat, lng, radius).index
+        if isinstance(counts, pd.DataFrame):
+            return counts.reindex(columns=names).sum(axis=1)
+        return counts.reindex(names).sum()
+
+    def nearest_affected(self, lat, lng, counts, n=5):
+        """
+        Nearest locations with positive counts.
+        inputs:
+            lat, lng: position in degrees
+            counts: Series of counts indexed by name
+            n: number of locations
+        outputs:
+            df: DataFrame of distance and count indexed by name, nearest first
+        """
+        affected = counts.index[counts.to_numpy(dtype=float) > 0]
+        distances = self.nearest(lat, lng, n, among=affected)
+        return pd.DataFrame({'distance': distances,
+                             'count': counts.reindex(distances.index)})
+
+
+def indexOf(positions):
+    """
+    Spatial index of geocode memory, built once and reused.
+    Positions are only added to the memory, so the memory is identified by
+    its size and its last name, the index is rebuilt when it grows.
+    inputs:
+        positions: dict of name -> (lat, lng), memory of MAPPER_SERVER
+    outputs:
+        index: SPATIAL_INDEX of positions
+    """
+    global _memory_index
+    key = (len(positions), next(reversed(positions), None))
+    if _memory_index[0] != key:
+        _memory_index = (key, SPATIAL_INDEX(positions))
+    return _memory_index[1]
@@ -0,0 +1,30 @@
+"""
+Shared fixtures of tests.
+Modules of the project are imported from the root of the repo,
+profiles point to temporary dirs, so bundled data is never touched.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from local_profiles import profiles  # noqa: E402
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """
+    Empty inventory and geocode memory in tmp_path, used by profiles.
+    outputs:
+        tmp_path: dir holding ncov_inventory and maper_server_memory
+    """
+    inventory_dir = tmp_path / 'ncov_inventory'
+    mapper_server_dir = tmp_path / 'maper_server_memory'
+    inventory_dir.mkdir()
+    mapper_server_dir.mkdir()
+    monkeypatch.setattr(profiles, 'inventory_dir', str(inventory_dir))
+    monkeypatch.setattr(profiles, 'mapper_server_dir', str(mapper_server_dir))
+    return tmp_path
@@ -0,0 +1,123 @@
+"""
+Tests of batch geocoding of MAPPER_SERVER with a fake backend.
+"""
+
+import os
+import pytest
+import mapper_server
+from mapper_server import MAPPER_SERVER
+
+
+class FAKE_BACKEND():
+    """
+    Backend of known positions, recording names it is called with.
+    Names in errors raise their errors in turn before they resolve.
+    """
+
+    def __init__(self, positions, errors=None):
+        self.positions = positions
+        self.errors = {k: list(v) for k, v in (errors or dict()).items()}
+        self.calls = []
+
+    def __call__(self, name):
+        self.calls.append(name)
+        if self.errors.get(name):
+            raise self.errors[name].pop(0)
+        if name not in self.positions:
+            raise KeyError(name)
+        return self.positions[name]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # Backoff of retries is recorded instead of slept
+    slept = []
+    monkeypatch.setattr(mapper_server.time, 'sleep', slept.append)
+    return slept
+
+
+def make_server(backend, **kwargs):
+    return MAPPER_SERVER(backend=backend, rate=None, use_gazetteer=False,
+                         **kwargs)
+
+
+def test_names_deduplicated_in_batch(sandbox):
+    backend = FAKE_BACKEND({'a': (30.0, 114.0), 'b': (31.0, 121.0)})
+    ms = make_server(backend)
+    df = ms.checkout_many(['a', 'b', 'a', 'b', 'a'])
+    assert sorted(backend.calls) == ['a', 'b']
+    assert list(df.index) == ['a', 'b', 'a', 'b', 'a']
+    assert df.loc['a'].iloc[0].tolist() == [30.0, 114.0]
+
+
+def test_key_error_not_retried(sandbox, sleeps):
+    backend = FAKE_BACKEND(dict())
+    ms = make_server(backend, retries=3)
+    df = ms.checkout_many(['nowhere'])
+    assert backend.calls == ['nowhere']
+    assert sleeps == []
+    assert df.isna().all().all()
+
+
+def test_transient_error_retried(sandbox, sleeps):
+    errors = {'a': [ConnectionError('reset'), TimeoutError('slow')]}
+    backend = FAKE_BACKEND({'a': (30.0, 114.0)}, errors=errors)
+    ms = make_server(backend, retries=3, backoff=0.5)
+    df = ms.checkout_many(['a'])
+    assert backend.calls == ['a'] * 3
+    assert len(sleeps) == 2 and sleeps[0] < sleeps[1]
+    assert df.loc['a'].tolist() == [30.0, 114.0]
+
+
+def test_retries_given_up(sandbox, sleeps):
+    errors = {'a': [ConnectionError('reset')] * 5}
+    backend = FAKE_BACKEND({'a': (30.0, 114.0)}, errors=errors)
+    ms = make_server(backend, retries=2)
+    df = ms.checkout_many(['a'])
+    assert backend.calls == ['a'] * 3
+    assert df.isna().all().all()
+
+
+def test_failed_names_shared_and_not_searched_again(sandbox):
+    backend = FAKE_BACKEND({'a': (30.0, 114.0)})
+    missing = set()
+    make_server(backend, missing=missing).checkout_many(['a', 'nowhere'])
+    assert missing == {'nowhere'}
+    # Another server sharing the set, like a worker of batch_render
+    ms = make_server(backend, missing=missing)
+    ms.checkout_many(['nowhere', 'nowhere'])
+    assert ms.checkout('nowhere') == (None, None)
+    assert backend.calls.count('nowhere') == 1
+
+
+def test_journal_replayed_after_crash(sandbox):
+    backend = FAKE_BACKEND({'a': (30.0, 114.0), 'b': (31.0, 121.0),
+                            'c': (39.9, 116.4)})
+    ms = make_server(backend)
+    ms.checkout_many(['a', 'b'])
+    ms.solid_memory()
+    assert not os.path.exists(ms.memory_path)
+    # A crash in the middle of appending leaves a broken last line
+    with open(ms.journal_path, 'ab') as f:
+        f.write(b'["broken", 1.0')
+
+    ms = make_server(backend)
+    assert ms.memory == {'a': (30.0, 114.0), 'b': (31.0, 121.0)}
+    ms.checkout_many(['c'])
+    ms.solid_memory()
+
+    ms = make_server(backend)
+    assert ms.memory == {'a': (30.0, 114.0), 'b': (31.0, 121.0),
+                         'c': (39.9, 116.4)}
+    assert backend.calls == ['a', 'b', 'c']
+
+
+def test_journal_compacted(sandbox, monkeypatch):
+    monkeypatch.setattr(mapper_server, 'JOURNAL_LIMIT', 1)
+    backend = FAKE_BACKEND({'a': (30.0, 114.0), 'b': (31.0, 121.0)})
+    ms = make_server(backend)
+    ms.checkout_many(['a', 'b'])
+    ms.solid_memory()
+    assert os.path.exists(ms.memory_path)
+    assert not os.path.exists(ms.journal_path)
+    assert make_server(backend).memory == ms.memory
@@ -0,0 +1,86 @@
+"""
+Tests of POLLER against REPLAY_SERVER, the local stand-in of REMOTE_URL.
+"""
+
+import copy
+import pytest
+import instrument
+from bench_parse import make_page
+from poller import POLLER
+from replay_server import REPLAY_SERVER
+from snapshot_store import listSnapshots, readTables
+
+TIMESTAMP = 1580000000
+AREA_STAT = [
+    {'provinceName': '湖北省', 'provinceShortName': '湖北',
+     'confirmedCount': 10, 'suspectedCount': 0, 'curedCount': 1,
+     'deadCount': 0, 'comment': '', 'locationId': 420000,
+     'cities': [{'cityName': '武汉', 'confirmedCount': 8, 'suspectedCount': 0,
+                 'curedCount': 1, 'deadCount': 0, 'locationId': 420100},
+                {'cityName': '孝感', 'confirmedCount': 2, 'suspectedCount': 0,
+                 'curedCount': 0, 'deadCount': 0, 'locationId': 420900}]},
+    {'provinceName': '广东省', 'provinceShortName': '广东',
+     'confirmedCount': 3, 'suspectedCount': 0, 'curedCount': 0,
+     'deadCount': 0, 'comment': '', 'locationId': 440000,
+     'cities': [{'cityName': '深圳', 'confirmedCount': 3, 'suspectedCount': 0,
+                 'curedCount': 0, 'deadCount': 0, 'locationId': 440300}]},
+]
+
+
+def counted(name):
+    # Value of counter of instrument
+    return instrument.summary()['counters'].get(name, 0)
+
+
+@pytest.fixture
+def replay():
+    """
+    Replay server of three pages, each served twice:
+    the first page, the same areaStat in a new page, and a changed areaStat.
+    """
+    changed = copy.deepcopy(AREA_STAT)
+    changed[1]['confirmedCount'] += 1
+    changed[1]['cities'][0]['confirmedCount'] += 1
+    pages = [make_page(AREA_STAT, TIMESTAMP),
+             make_page(AREA_STAT, TIMESTAMP + 60),
+             make_page(changed, TIMESTAMP + 120)]
+    server = REPLAY_SERVER(pages, repeat=2)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_poll_once(sandbox, replay):
+    not_modified = counted('poller.not_modified')
+    unchanged = counted('poller.unchanged')
+    poller = POLLER(url=replay.url)
+    first = poller.poll_once()
+    assert first is not None
+    # Conditional request of the same page
+    assert poller.poll_once() is None
+    assert counted('poller.not_modified') == not_modified + 1
+    # New page of the same areaStat is not saved
+    assert poller.poll_once() is None
+    assert counted('poller.unchanged') == unchanged + 1
+    assert poller.poll_once() is None
+    assert counted('poller.not_modified') == not_modified + 2
+    changed = poller.poll_once()
+    assert changed is not None and changed != first
+    assert replay.requests == 5
+
+    snapshots = listSnapshots()
+    assert list(snapshots.values()) == [first, changed]
+    prov_df, city_df = readTables(changed)
+    assert prov_df.set_index('provinceName')['confirmedCount'].to_dict() == \
+        {'湖北省': 10, '广东省': 4}
+    assert city_df.set_index('cityName')['confirmedCount']['深圳'] == 4
+
+
+def test_state_kept_across_pollers(sandbox, replay):
+    POLLER(url=replay.url).poll_once()
+    # A restarted poller sends the ETag and hash of the last poll
+    poller = POLLER(url=replay.url)
+    assert poller.state['etag'] is not None
+    assert poller.poll_once() is None
+    assert len(listSnapshots()) == 1
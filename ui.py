@@ -1,51 +1,57 @@
 """
 Main ui of the project.
+Plotting libraries are imported on the first painting,
+listing and querying the inventory starts fast.
 """
 
-import time
-
-t = time.time()
-
-from local_profiles import profiles
-print('{} seconds passed'.format(time.time() - t))
 from local_toolbox import readDF
-print('{} seconds passed'.format(time.time() - t))
 from inventory_manager import INV_MANAGER
-print('{} seconds passed'.format(time.time() - t))
-from painter import PAINTER
-print('{} seconds passed'.format(time.time() - t))
-from pprint import pprint
-print('{} seconds passed'.format(time.time() - t))
 
-manager = INV_MANAGER()
-painter = PAINTER()
+manager = None
+painter = None
+metric = None
+
 
 def printer(df):
+    global painter
     if df is not None:
+        if painter is None:
+            from painter import PAINTER
+            painter = PAINTER()
         painter.load(readDF(df['path'].values[-1]))
+        if metric is not None:
+            from analytics import inventory_metrics
+            day = df['date'].values[-1]
+            painter.color_by(inventory_metrics(manager), metric, day=day)
         print(painter.country_df)
         print(painter.provinces_df)
         painter.draw()
     else:
         print('No record selected.')
 
-s = ''
-df = None
-while not s == 'q':
-    if s == 'l':
-        # List inventory
-        manager.list_count_files()
-    if s == 'u':
-        # Update inventory
-        manager._update_inventory()
-    if s == 'p':
-        # Print selected
-        printer(df)
-    if s.startswith('d'):
-        # Get entries on data
-        df = manager.get_count_file_on_date(s.split()[1])
-    if s.startswith('i'):
-        # Get entry on index
-        df = manager.get_count_file_on_idx(int(s.split()[1]))
-    s = input(f'{df}\n>> ')
-print('Done.')
\ No newline at end of file
+
+if __name__ == '__main__':
+    manager = INV_MANAGER()
+    s = ''
+    df = None
+    while not s == 'q':
+        if s == 'l':
+            # List inventory
+            manager.list_count_files()
+        if s == 'u':
+            # Update inventory
+            manager._update_inventory()
+        if s == 'p':
+            # Print selected
+            printer(df)
+        if s.startswith('d'):
+            # Get entries on data
+            df = manager.get_count_file_on_date(s.split()[1])
+        if s.startswith('i'):
+            # Get entry on index
+            df = manager.get_count_file_on_idx(int(s.split()[1]))
+        if s.startswith('c'):
+            # Color by metric, or confirmedCount if no metric given
+            metric = (s.split() + [None])[1]
+        s = input(f'{df}\n>> ')
+    print('Done.')
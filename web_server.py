@@ -0,0 +1,422 @@
+"""
+Local HTTP server of maps and data of the inventory.
+Built on asyncio streams, painting runs in a single worker thread.
+Parsed snapshots and response bodies are kept in LRU caches,
+bodies carry strong ETags and are compressed once, with gzip and brotli
+if brotli is installed, so many viewers of the same map cost one render.
+Routes:
+    /                                   map of the latest snapshot
+    /snapshots                          list of snapshots
+    /snapshots/<stamp>/country.json     counts of provinces
+    /snapshots/<stamp>/provinces.json   counts and positions of cities
+    /maps/<stamp>.html                  map of snapshot
+    /maps/<file>                        js and json files of split or lazy maps
+    stamp may be 'latest'.
+    INVENTORY_TTL: seconds between checks of the inventory
+Usage:
+    python web_server.py [--host 127.0.0.1] [--port 8080] [--cache-size 32]
+"""
+
+import os
+import gzip
+import json
+import asyncio
+import hashlib
+import argparse
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from inventory_manager import INV_MANAGER
+from snapshot_store import stampOf
+from instrument import span, count
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+INVENTORY_TTL = 10
+RENDER_DIR = 'maps'
+HTML_FILENAME = 'ncov_map_{}.html'
+# Files of split and lazy maps fetched by their pages
+STATIC_TYPES = {'.js': 'application/javascript; charset=utf-8',
+                '.json': 'application/json; charset=utf-8'}
+STATUS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+          404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+
+class LRU_CACHE():
+    """
+    Least recently used cache of limited entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class BODY():
+    """
+    Response body with compressed variants, each with its strong ETag.
+    """
+
+    def __init__(self, content, content_type):
+        """
+        Builtin init method.
+        inputs:
+            content: bytes of body
+            content_type: value of Content-Type
+        """
+        self.content_type = content_type
+        self.variants = {'identity': content,
+                         'gzip': gzip.compress(content, compresslevel=6)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(content)
+        # Variants differ in bytes, so they differ in strong ETags
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        self.etags = {encoding: '"{}"'.format(digest if encoding == 'identity'
+                                              else f'{digest}-{encoding}')
+                      for encoding in self.variants}
+
+    def negotiate(self, accept_encoding):
+        """
+        Choose variant by Accept-Encoding.
+        inputs:
+            accept_encoding: value of Accept-Encoding, None if not given
+        outputs:
+            encoding: chosen encoding
+            etag: ETag of the variant
+            content: bytes of the variant
+        """
+        accepted = set()
+        for token in (accept_encoding or '').split(','):
+            coding, _, params = token.strip().partition(';')
+            if params.strip().replace(' ', '') in ['q=0', 'q=0.0']:
+                continue
+            accepted.add(coding.strip().lower())
+        for encoding in ['br', 'gzip']:
+            if encoding in self.variants and encoding in accepted:
+                return encoding, self.etags[encoding], self.variants[encoding]
+        return 'identity', self.etags['identity'], self.variants['identity']
+
+
+def _matches(if_none_match, etags):
+    # Weak comparison of If-None-Match, as RFC 7232 requires for GET,
+    # a cached copy of any variant is still valid
+    if if_none_match is None:
+        return False
+    tags = [e.strip() for e in if_none_match.split(',')]
+    return '*' in tags or any(e in etags for e in
+                              [e[2:] if e.startswith('W/') else e for e in tags])
+
+
+class WEB_SERVER():
+    def __init__(self, cache_size=32, render_dir=RENDER_DIR):
+        """
+        Builtin init method.
+        inputs:
+            cache_size: number of parsed snapshots and bodies kept in memory
+            render_dir: dir of rendered maps, shared with batch_render
+        """
+        logging.info('WEB_SERVER starts.')
+        self.manager = INV_MANAGER()
+        self.render_dir = render_dir
+        self.snapshots = LRU_CACHE(cache_size)
+        self.bodies = LRU_CACHE(cache_size)
+        # Painting and geocode memory are not thread safe, one worker only
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = dict()
+        self.checked = 0
+
+    async def _stamps(self):
+        """
+        Stamps of inventory, inventory is checked every INVENTORY_TTL seconds
+        in worker thread, so the loop keeps serving while files are read.
+        outputs:
+            stamps: dict of stamp -> path of snapshot
+        """
+        loop = asyncio.get_running_loop()
+        if loop.time() - self.checked > INVENTORY_TTL:
+            # Requests during the check use the inventory checked last time
+            self.checked = loop.time()
+            await loop.run_in_executor(self.executor,
+                                       self.manager._check_inventory)
+        paths = self.manager.COUNT_FILE_DF['path']
+        return dict(zip(paths.map(stampOf), paths))
+
+    async def _resolve(self, stamp):
+        # Path of snapshot of stamp, KeyError if not found
+        stamps = await self._stamps()
+        if stamp == 'latest' and stamps:
+            stamp = list(stamps)[-1]
+        return stamp, stamps[stamp]
+
+    async def _once(self, key, work):
+        """
+        Get body of key from cache, or make it in worker thread once,
+        concurrent requests of the same key wait for the same work.
+        inputs:
+            key: key of body, changes with the snapshot file
+            work: function making (content, content_type)
+        outputs:
+            body: BODY of key
+        """
+        body = self.bodies.get(key)
+        if body is not None:
+            count('web.body_hit')
+            return body
+        if key not in self.pending:
+            count('web.body_miss')
+            loop = asyncio.get_running_loop()
+
+            def make():
+                return BODY(*work())
+            self.pending[key] = loop.run_in_executor(self.executor, make)
+        future = self.pending[key]
+        try:
+            body = await asyncio.shield(future)
+        finally:
+            self.pending.pop(key, None)
+        self.bodies.put(key, body)
+        return body
+
+    def _painter(self, stamp, path):
+        """
+        Parsed snapshot as loaded PAINTER, runs in worker thread.
+        inputs:
+            stamp: stamp of snapshot
+            path: path of snapshot
+        outputs:
+            painter: PAINTER loaded with the snapshot
+        """
+        # Plotting libraries are imported on the first request
+        from painter import PAINTER
+        from local_toolbox import readDF
+        key = (path, os.path.getmtime(path))
+        painter = self.snapshots.get(key)
+        if painter is None:
+            painter = PAINTER()
+            painter.load(readDF(path))
+            self.snapshots.put(key, painter)
+        return painter
+
+    def _render(self, stamp, path):
+        """
+        Render map of snapshot, runs in worker thread.
+        Map rendered by batch_render after the snapshot is used as it is.
+        inputs:
+            stamp: stamp of snapshot
+            path: path of snapshot
+        outputs:
+            content, content_type: html of the map
+        """
+        from render_cache import RENDER_CACHE
+        os.makedirs(self.render_dir, exist_ok=True)
+        html_path = os.path.join(self.render_dir, HTML_FILENAME.format(stamp))
+        if (not os.path.exists(html_path)
+                or os.path.getmtime(html_path) < os.path.getmtime(path)):
+            with span('web.render'):
+                self._painter(stamp, path).draw(HTML_FILENAME=html_path,
+                                                show=False,
+                                                cache=RENDER_CACHE())
+        with open(html_path, 'rb') as f:
+            return f.read(), 'text/html; charset=utf-8'
+
+    def _static(self, names):
+        """
+        Path of file under render dir.
+        inputs:
+            names: list of names of dirs and file, relative to render dir
+        outputs:
+            path: path of file, KeyError if not found or outside render dir
+        """
+        root = os.path.realpath(self.render_dir)
+        path = os.path.realpath(os.path.join(root, *names))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise KeyError('/'.join(names))
+        return path
+
+    def _file(self, path):
+        # Content of static file, runs in worker thread
+        with open(path, 'rb') as f:
+            return f.read(), STATIC_TYPES[os.path.splitext(path)[1]]
+
+    def _country(self, stamp, path):
+        df = self._painter(stamp, path).country_df
+        return (df.to_json(orient='records', force_ascii=False).encode(),
+                'application/json; charset=utf-8')
+
+    def _provinces(self, stamp, path):
+        df = self._painter(stamp, path).provinces_df
+        return (df.to_json(orient='records', force_ascii=False).encode(),
+                'application/json; charset=utf-8')
+
+    def _list(self):
+        df = self.manager.COUNT_FILE_DF
+        records = [{'stamp': stampOf(path), 'date': date, 'sum': int(total)}
+                   for date, path, total in zip(df['date'], df['path'], df['sum'])]
+        content = json.dumps(records, ensure_ascii=False).encode()
+        return content, 'application/json; charset=utf-8'
+
+    async def route(self, target):
+        """
+        Get body of request target.
+        inputs:
+            target: path of request
+        outputs:
+            body: BODY of response, KeyError if not found
+        """
+        parts = [e for e in target.split('?')[0].split('/') if e]
+        if not parts:
+            parts = ['maps', 'latest.html']
+        if parts == ['snapshots']:
+            stamps = await self._stamps()
+            return await self._once(('list', tuple(stamps)), self._list)
+        if len(parts) == 3 and parts[0] == 'snapshots':
+            work = {'country.json': self._country,
+                    'provinces.json': self._provinces}[parts[2]]
+            stamp, path = await self._resolve(parts[1])
+        elif (len(parts) == 2 and parts[0] == 'maps'
+                and parts[1].endswith('.html')):
+            work = self._render
+            stamp, path = await self._resolve(parts[1][:-len('.html')])
+        elif (len(parts) >= 2 and parts[0] == 'maps'
+                and os.path.splitext(parts[-1])[1] in STATIC_TYPES):
+            path = self._static(parts[1:])
+            key = ('file', path, os.path.getmtime(path))
+            return await self._once(key, lambda: self._file(path))
+        else:
+            raise KeyError(target)
+        key = (work.__name__, path, os.path.getmtime(path))
+        return await self._once(key, lambda: work(stamp, path))
+
+    async def handle(self, reader, writer):
+        """
+        Serve requests of a connection, kept alive as HTTP/1.1.
+        inputs:
+            reader, writer: streams of the connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400)
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                await self.serve(writer, method, target, headers)
+                if (headers.get('connection', '').lower() == 'close'
+                        or version == 'HTTP/1.0'):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, writer, method, target, headers):
+        """
+        Serve a request.
+        inputs:
+            writer: stream of the connection
+            method: method of request
+            target: path of request
+            headers: dict of lowercase name -> value of request headers
+        """
+        count('web.request')
+        if method not in ['GET', 'HEAD']:
+            await self.respond(writer, 405, {'Allow': 'GET, HEAD'})
+            return
+        try:
+            body = await self.route(target)
+        except KeyError:
+            await self.respond(writer, 404)
+            return
+        except Exception as err:
+            logging.error(f'Fail on serving {target}: {repr(err)}')
+            await self.respond(writer, 500)
+            return
+        encoding, etag, content = body.negotiate(headers.get('accept-encoding'))
+        common = {'ETag': etag,
+                  'Cache-Control': 'no-cache',
+                  'Vary': 'Accept-Encoding'}
+        if _matches(headers.get('if-none-match'), body.etags.values()):
+            count('web.not_modified')
+            await self.respond(writer, 304, common)
+            return
+        common['Content-Type'] = body.content_type
+        if encoding != 'identity':
+            common['Content-Encoding'] = encoding
+        await self.respond(writer, 200, common, content,
+                           send_body=method == 'GET')
+
+    async def respond(self, writer, status, headers=None, content=b'', send_body=True):
+        """
+        Write a response.
+        inputs:
+            writer: stream of the connection
+            status: status code
+            headers: dict of response headers
+            content: bytes of body
+            send_body: False for HEAD, Content-Length is kept
+        """
+        lines = [f'HTTP/1.1 {status} {STATUS[status]}']
+        headers = dict(headers or dict())
+        if status != 304:
+            headers['Content-Length'] = str(len(content))
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if send_body and status != 304:
+            writer.write(content)
+        await writer.drain()
+
+    async def run(self, host='127.0.0.1', port=8080):
+        """
+        Serve forever.
+        inputs:
+            host: host to bind
+            port: port to bind
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        message = f'Serving on http://{host}:{port}/'
+        print(message)
+        logging.info(message)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='host to bind')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to bind')
+    parser.add_argument('--cache-size', type=int, default=32,
+                        help='number of snapshots and bodies kept in memory')
+    args = parser.parse_args()
+    server = WEB_SERVER(cache_size=args.cache_size)
+    try:
+        asyncio.run(server.run(host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        print('Done.')